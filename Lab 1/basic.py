@@ -5,102 +5,67 @@
 ##      Open CV and Numpy integration        ##
 ###############################################
 
-import pyrealsense2 as rs
 import numpy as np
+import os
+import sys
 import cv2
 
-# Configure depth and color streams
-pipeline = rs.pipeline()
-config = rs.config()
+# Modules shared by the labs and the project (framesource, calibration, protocol...) live in common/
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'common'))
+from framesource import open_source
+from markers import MarkerTracker
+from geometry import polygon_centroids
 
-# Get device product line for setting a supporting resolution
-pipeline_wrapper = rs.pipeline_wrapper(pipeline)
-pipeline_profile = config.resolve(pipeline_wrapper)
-device = pipeline_profile.get_device()
-device_product_line = str(device.get_info(rs.camera_info.product_line))
-
-found_rgb = False
-for s in device.sensors:
-    if s.get_info(rs.camera_info.name) == 'RGB Camera':
-        found_rgb = True
-        break
-if not found_rgb:
-    print("The demo requires Depth camera with Color sensor")
-    exit(0)
-
-config.enable_stream(rs.stream.depth, 640, 480, rs.format.z16, 30)
-config.enable_stream(rs.stream.color, 640, 480, rs.format.bgr8, 30)
+# Configure depth and color streams (or replay a recorded session, see framesource.py)
+source = open_source(640, 480, 30, align=False)
 
 arucoDict = cv2.aruco.getPredefinedDictionary(cv2.aruco.DICT_6X6_250)
 arucoParams = cv2.aruco.DetectorParameters()
 arucoDetector = cv2.aruco.ArucoDetector(arucoDict, arucoParams)
+markerTracker = MarkerTracker(arucoDetector, rescan_every=30)
 
-# Start streaming
-pipeline.start(config)
-
+SHOW_DEPTH = True       # show the depth colormap next to the color image
 counter = 0
 
 
-def centroid(vertices):
-    x, y = 0, 0
-    n = len(vertices)
-    signed_area = 0
-    for i in range(len(vertices)):
-        x0, y0 = vertices[i]
-        x1, y1 = vertices[(i + 1) % n]
-        # shoelace formula
-        area = (x0 * y1) - (x1 * y0)
-        signed_area += area
-        x += (x0 + x1) * area
-        y += (y0 + y1) * area
-    signed_area *= 0.5
-    x /= 6 * signed_area
-    y /= 6 * signed_area
-    return int(x), int(y)
-
 try:
     while True:
         # Wait for a coherent pair of frames: depth and color
-        frames = pipeline.wait_for_frames()
-        depth_frame = frames.get_depth_frame()
-        color_frame = frames.get_color_frame()
-        if not depth_frame or not color_frame:
+        frame = source.read()
+        if frame is None:
+            if source.exhausted:
+                break
             continue
-        depth_intrinsics = depth_frame.profile.as_video_stream_profile().intrinsics
-
-        # Convert images to numpy arrays
-        depth_image = np.asanyarray(depth_frame.get_data())
-        color_image = np.asanyarray(color_frame.get_data())
+        # Numpy view of the frame
+        color_image = frame.color_image
         
-        corners, ids, rejected = arucoDetector.detectMarkers(color_image)
+        corners, ids = markerTracker.detect(color_image)
         
         if (counter % 50 == 0):
-            ans = {}
-            for i in range(len(corners)):
-                x, y = centroid(corners[i][0])
-                depth = depth_frame.get_distance(x, y)
-                # print(corners[i][0], x, y, depth, ids[i][0])
-                ans[int(ids[i][0])] = rs.rs2_deproject_pixel_to_point(depth_intrinsics, [x, y], depth)
-                # print(rs.rs2_deproject_pixel_to_point(depth_intrinsics, [x, y], depth))
-                # printed = True
+            # Marker centroids, deprojected in one call
+            points = frame.deproject(polygon_centroids(corners))
+            ans = {int(id): point for id, point in zip(np.ravel(ids), points.tolist())}
             print(ans)
+            print("Marker detection:", markerTracker.stats())
             print("====================================================")
 
         counter += 1
 
         color_image = cv2.aruco.drawDetectedMarkers(color_image, corners, ids)
-        # Apply colormap on depth image (image must be converted to 8-bit per pixel first)
-        depth_colormap = cv2.applyColorMap(cv2.convertScaleAbs(depth_image, alpha=0.03), cv2.COLORMAP_JET)
+        images = color_image
+        if SHOW_DEPTH:
+            # Computed on first read, frame.depth_colormap is not built when it is off
+            depth_colormap = frame.depth_colormap
 
-        depth_colormap_dim = depth_colormap.shape
-        color_colormap_dim = color_image.shape
+            depth_colormap_dim = depth_colormap.shape
+            color_colormap_dim = color_image.shape
 
-        # If depth and color resolutions are different, resize color image to match depth image for display
-        if depth_colormap_dim != color_colormap_dim:
-            resized_color_image = cv2.resize(color_image, dsize=(depth_colormap_dim[1], depth_colormap_dim[0]), interpolation=cv2.INTER_AREA)
-            images = np.hstack((resized_color_image, depth_colormap))
-        else:
-            images = np.hstack((color_image, depth_colormap))
+            # If depth and color resolutions are different, resize color image to match depth image for display
+            if depth_colormap_dim != color_colormap_dim:
+                resized_color_image = cv2.resize(color_image, dsize=(depth_colormap_dim[1], depth_colormap_dim[0]), interpolation=cv2.INTER_AREA)
+                images = np.hstack((resized_color_image, depth_colormap))
+            else:
+                images = np.hstack((color_image, depth_colormap))
 
         # Show images
         cv2.namedWindow('RealSense', cv2.WINDOW_AUTOSIZE)
@@ -109,5 +74,5 @@ try:
 
 finally:
     # Stop streaming
-    pipeline.stop()
+    source.stop()
     
\ No newline at end of file
@@ -6,120 +6,145 @@
 ###############################################
 
 import os
-import pyrealsense2 as rs
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
 import numpy as np
 import cv2
-import tensorflow as tf
 
+# Modules shared by the labs and the project (framesource, calibration, protocol...) live in common/
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'common'))
+from framesource import open_source
+from engine import DetectionEngine
+
+# Set before tensorflow is imported (in load_detector) to take effect
 os.environ['TF_ENABLE_ONEDNN_OPTS'] = '0'
 os.environ['TF_CPP_MIN_LOG_LEVEL'] = '1' 
 
-# Configure depth and color streams
-pipeline = rs.pipeline()
-config = rs.config()
-
-# Get device product line for setting a supporting resolution
-pipeline_wrapper = rs.pipeline_wrapper(pipeline)
-pipeline_profile = config.resolve(pipeline_wrapper)
-device = pipeline_profile.get_device()
-device_product_line = str(device.get_info(rs.camera_info.product_line))
-
-found_rgb = False
-for s in device.sensors:
-    if s.get_info(rs.camera_info.name) == 'RGB Camera':
-        found_rgb = True
-        break
-if not found_rgb:
-    print("The demo requires Depth camera with Color sensor")
-    exit(0)
-
-config.enable_stream(rs.stream.depth, 640, 480, rs.format.z16, 30)
-config.enable_stream(rs.stream.color, 640, 480, rs.format.bgr8, 30)
-
-# Start streaming
-pipeline.start(config)
-
-detection_graph = tf.Graph()
-with detection_graph.as_default():
-    od_graph_def = tf.compat.v1.GraphDef()
-    # Path may need to be changed.
-    with tf.compat.v1.gfile.GFile(r"C:\Users\student\Downloads\1131isd\lab1\model\frozen_inference_graph.pb", 'rb') as fid:
-        serialized_graph = fid.read()
-        od_graph_def.ParseFromString(serialized_graph)
+# Path may need to be changed (or set SSD_MODEL).
+MODEL_PATH = os.environ.get('SSD_MODEL', os.path.join(os.path.dirname(os.path.abspath(__file__)), 'model', 'frozen_inference_graph.pb'))
+OUTPUTS = ['detection_boxes', 'detection_scores', 'detection_classes', 'num_detections']
+
+
+def timed(timings, name, function, *args, **kwargs):
+    start = time.perf_counter()
+    result = function(*args, **kwargs)
+    timings[name] = time.perf_counter() - start
+    return result
+
+
+def load_graph_def(tf, path):
+    "Frozen graph pruned to the detection outputs, cached next to the model after the first run"
+    cache_path = path + '.pruned'
+    graph_def = tf.compat.v1.GraphDef()
+    if os.path.exists(cache_path) and os.path.getmtime(cache_path) >= os.path.getmtime(path):
+        with open(cache_path, 'rb') as fid:
+            graph_def.ParseFromString(fid.read())
+        return graph_def
+    with open(path, 'rb') as fid:
+        graph_def.ParseFromString(fid.read())
+    graph_def = tf.compat.v1.graph_util.extract_sub_graph(graph_def, OUTPUTS)
+    with open(cache_path, 'wb') as fid:
+        fid.write(graph_def.SerializeToString())
+    print(f"[INFO] Cached the pruned detection graph to {cache_path}")
+    return graph_def
+
+
+def load_detector(timings):
+    "Import tensorflow, load the graph and run it once on a blank frame"
+    tf = timed(timings, 'tensorflow', __import__, 'tensorflow')
+    detection_graph = tf.Graph()
+    with detection_graph.as_default():
+        od_graph_def = timed(timings, 'graph', load_graph_def, tf, MODEL_PATH)
         tf.compat.v1.import_graph_def(od_graph_def, name='')
-    sess = tf.compat.v1.Session(graph=detection_graph)
+        sess = tf.compat.v1.Session(graph=detection_graph)
+
+    image_tensor = detection_graph.get_tensor_by_name('image_tensor:0')
+    output_tensors = [detection_graph.get_tensor_by_name(name + ':0') for name in OUTPUTS]
+
+    # The first sess.run initializes the kernels, pay it before the camera loop starts
+    timed(timings, 'warm-up', sess.run, output_tensors,
+          feed_dict={image_tensor: np.zeros((1, 480, 640, 3), np.uint8)})
+    return sess, image_tensor, output_tensors
+
 
-image_tensor = detection_graph.get_tensor_by_name('image_tensor:0')
-detection_boxes = detection_graph.get_tensor_by_name('detection_boxes:0')
-detection_scores = detection_graph.get_tensor_by_name('detection_scores:0')
-detection_classes = detection_graph.get_tensor_by_name('detection_classes:0')
-num_detections = detection_graph.get_tensor_by_name('num_detections:0')
+# Open the camera while tensorflow loads
+startup = time.perf_counter()
+timings = {}
+with ThreadPoolExecutor(max_workers=2) as executor:
+    # Configure depth and color streams (or replay a recorded session, see framesource.py)
+    camera = executor.submit(timed, timings, 'camera', open_source, 640, 480, 30, align=False)
+    detector = executor.submit(load_detector, timings)
+    source = camera.result()
+    sess, image_tensor, output_tensors = detector.result()
+timings['total'] = time.perf_counter() - startup
+print("[INFO] Startup:", ", ".join(f"{name} {seconds:.2f} s" for name, seconds in timings.items()))
 
+# Run the detector on its own thread, batching frames when it falls behind
+engine = DetectionEngine(sess, image_tensor, output_tensors, threshold=0.8, max_batch=4)
+
+SHOW_DEPTH = True       # show the depth colormap next to the color image
 colors_hash = {}
 counter = 0
+frame_id = 0
+pending = {}        # frame_id -> frame waiting for its detections
+detections = None   # latest detections, drawn on every frame
 
 try:
     while True:
         # Wait for a coherent pair of frames: depth and color
-        frames = pipeline.wait_for_frames()
-        depth_frame = frames.get_depth_frame()
-        color_frame = frames.get_color_frame()
-        if not depth_frame or not color_frame:
+        frame = source.read()
+        if frame is None:
+            if source.exhausted:
+                break
             continue
-        depth_intrinsics = depth_frame.profile.as_video_stream_profile().intrinsics
-
-        # Convert images to numpy arrays
-        depth_image = np.asanyarray(depth_frame.get_data())
-        color_image = np.asanyarray(color_frame.get_data())
-
-        obj_coordinate = {}
-        image_expanded = np.expand_dims(color_image, axis=0)
-        (boxes, scores, classes, num) = sess.run([detection_boxes, detection_scores, detection_classes, num_detections],
-                                         feed_dict={image_tensor: image_expanded})
-        boxes = np.squeeze(boxes)
-        classes = np.squeeze(classes).astype(np.int32)
-        scores = np.squeeze(scores)
-
-        for idx in range(int(num)):
-            class_ = classes[idx]
-            score = scores[idx]
-            box = boxes[idx]
-            if class_ not in colors_hash:
-                colors_hash[class_] = tuple(np.random.choice(range(256), size=3))
-            
-            if score > 0.8:
-                left = int(box[1] * color_frame.width)
-                top = int(box[0] * color_frame.height)
-                right = int(box[3] * color_frame.width)
-                bottom = int(box[2] * color_frame.height)
-                p1 = (left, top)
-                p2 = (right, bottom)
-                # draw box
+        color_image = frame.color_image
+
+        engine.submit(frame_id, color_image)
+        pending[frame_id] = frame
+        frame_id += 1
+
+        # Collect the detections that finished, with the frame they were run on
+        for done_id, done in engine.poll():
+            done_frame = pending.pop(done_id)
+            for old_id in [i for i in pending if i < done_id]:
+                del pending[old_id]     # dropped by the engine
+            detections = done
+
+            centroids = detections['centroids']
+            points = done_frame.deproject(centroids)
+            obj_coordinate = {int(idx): point.tolist() for idx, point in zip(detections['index'], points)}
+
+            if counter >= 60:
+                print(obj_coordinate)
+                print("Engine:", engine.stats())
+                counter = 0
+            else:
+                counter += 1
+
+        # Draw the latest boxes on the current frame (on a copy, the engine may still be reading it)
+        if detections is not None:
+            color_image = color_image.copy()
+            for class_, (left, top, right, bottom) in zip(detections['classes'], detections['boxes']):
+                if class_ not in colors_hash:
+                    colors_hash[class_] = tuple(np.random.choice(range(256), size=3))
                 r, g, b = colors_hash[class_]
-                cv2.rectangle(color_image, p1, p2, (int(r), int(g), int(b)), 2, 1)
-                midpt_x = (left + right)//2
-                midpt_y = (top + bottom)//2
-                depth = depth_frame.get_distance(midpt_x, midpt_y)
-                obj_coordinate[idx] = rs.rs2_deproject_pixel_to_point(depth_intrinsics, [midpt_x, midpt_y], depth)
-
-        if counter >= 60:
-            print(obj_coordinate)
-            counter = 0
-        else:
-            counter += 1
-        
-        # Apply colormap on depth image (image must be converted to 8-bit per pixel first)
-        depth_colormap = cv2.applyColorMap(cv2.convertScaleAbs(depth_image, alpha=0.03), cv2.COLORMAP_JET)
-
-        depth_colormap_dim = depth_colormap.shape
-        color_colormap_dim = color_image.shape
-
-        # If depth and color resolutions are different, resize color image to match depth image for display
-        if depth_colormap_dim != color_colormap_dim:
-            resized_color_image = cv2.resize(color_image, dsize=(depth_colormap_dim[1], depth_colormap_dim[0]), interpolation=cv2.INTER_AREA)
-            images = np.hstack((resized_color_image, depth_colormap))
-        else:
-            images = np.hstack((color_image, depth_colormap))
+                cv2.rectangle(color_image, (int(left), int(top)), (int(right), int(bottom)), (int(r), int(g), int(b)), 2, 1)
+
+        images = color_image
+        if SHOW_DEPTH:
+            # Computed on first read, frame.depth_colormap is not built when it is off
+            depth_colormap = frame.depth_colormap
+
+            depth_colormap_dim = depth_colormap.shape
+            color_colormap_dim = color_image.shape
+
+            # If depth and color resolutions are different, resize color image to match depth image for display
+            if depth_colormap_dim != color_colormap_dim:
+                resized_color_image = cv2.resize(color_image, dsize=(depth_colormap_dim[1], depth_colormap_dim[0]), interpolation=cv2.INTER_AREA)
+                images = np.hstack((resized_color_image, depth_colormap))
+            else:
+                images = np.hstack((color_image, depth_colormap))
 
         # Show images
         cv2.namedWindow('RealSense', cv2.WINDOW_AUTOSIZE)
@@ -128,5 +153,6 @@ try:
 
 finally:
     # Stop streaming
-    pipeline.stop()
+    engine.stop()
+    source.stop()
     
\ No newline at end of file
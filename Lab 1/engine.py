@@ -0,0 +1,103 @@
+'''
+Asynchronous SSD inference
+
+The frozen detection graph runs on a worker thread so capture never waits
+for sess.run. Frames queued while the model is busy are run together as one
+batch, and the oldest frames are dropped if the queue grows past max_queue.
+Results come back tagged with the id the frame was submitted with.
+'''
+import threading
+import time
+from collections import deque
+
+import numpy as np
+
+
+def postprocess(boxes, scores, classes, num, width, height, threshold):
+    "Score filtering and pixel boxes / centroids for one image, vectorized"
+    n = int(num)
+    keep = np.flatnonzero(scores[:n] > threshold)
+    # boxes are normalized (top, left, bottom, right)
+    pixels = (boxes[keep] * (height, width, height, width)).astype(np.int32)
+    top, left, bottom, right = pixels.T
+    return {
+        'index': keep,
+        'classes': classes[keep].astype(np.int32),
+        'scores': scores[keep],
+        'boxes': np.stack([left, top, right, bottom], axis=1),
+        'centroids': np.stack([(left + right) // 2, (top + bottom) // 2], axis=1),
+    }
+
+
+class DetectionEngine:
+    def __init__(self, sess, image_tensor, output_tensors, threshold=0.8, max_batch=4, max_queue=8):
+        '''
+        output_tensors  [detection_boxes, detection_scores, detection_classes, num_detections]
+        threshold       minimum detection score
+        '''
+        self.sess = sess
+        self.image_tensor = image_tensor
+        self.output_tensors = output_tensors
+        self.threshold = threshold
+        self.max_batch = max_batch
+        self.queue = deque(maxlen=max_queue)    # (frame_id, image), oldest dropped first
+        self.results = deque()                  # (frame_id, detections)
+        self.condition = threading.Condition()
+        self.submitted = 0
+        self.dropped = 0
+        self.batches = 0
+        self.batch_latency = 0.0
+        self.running = True
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+
+    def submit(self, frame_id, image):
+        "Queue an image, the caller must not modify it until its result is back"
+        with self.condition:
+            if len(self.queue) == self.queue.maxlen:
+                self.dropped += 1
+            self.queue.append((frame_id, image))
+            self.submitted += 1
+            self.condition.notify()
+
+    def poll(self):
+        "All results finished since the last call, oldest first"
+        with self.condition:
+            results = list(self.results)
+            self.results.clear()
+        return results
+
+    def _run(self):
+        while True:
+            with self.condition:
+                self.condition.wait_for(lambda: self.queue or not self.running)
+                if not self.running:
+                    return
+                batch = [self.queue.popleft() for _ in range(min(self.max_batch, len(self.queue)))]
+
+            frame_ids = [frame_id for frame_id, _ in batch]
+            images = np.stack([image for _, image in batch])
+            height, width = images.shape[1:3]
+            start = time.perf_counter()
+            boxes, scores, classes, num = self.sess.run(self.output_tensors,
+                                                        feed_dict={self.image_tensor: images})
+            self.batch_latency = time.perf_counter() - start
+            detections = [postprocess(boxes[i], scores[i], classes[i], num[i], width, height, self.threshold)
+                          for i in range(len(batch))]
+
+            with self.condition:
+                self.results.extend(zip(frame_ids, detections))
+                self.batches += 1
+
+    def stats(self):
+        with self.condition:
+            return {'submitted': self.submitted,
+                    'dropped': self.dropped,
+                    'batches': self.batches,
+                    'batch_ms': round(self.batch_latency * 1000, 2)}
+
+    def stop(self):
+        with self.condition:
+            self.running = False
+            self.condition.notify()
+        self.thread.join(timeout=1.0)
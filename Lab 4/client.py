@@ -1,125 +1,97 @@
-import socket
-import json
+import time
+import os
+import sys
 import cv2
 import numpy as np
-import pyrealsense2 as rs
 
+# Modules shared by the labs and the project (framesource, calibration, protocol...) live in common/
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'common'))
 from mpipe import MediaPipe
+from framesource import open_source
+from markers import MarkerTracker
+from geometry import polygon_centroids
+from calibration import CalibrationAccumulator, PointBatch, save_calibration
+from filters import OneEuroFilter, PosePublisher
+from protocol import open_unity, DeltaEncoder
 
 HOST = "127.0.0.1"      # localhost
 HOST = "172.20.10.3"    # hotspot
 HOST = "192.168.1.120"  # csie523
 PORT = 999
 
+# Listen on this port and send the responses to every Unity that connects
+# (several headsets, a spectator view) instead of connecting to HOST:PORT
+SERVE_PORT = None
+
 CART_ID = [10, 100, 125, 230]
 REFILL_ID = [4]
 CALIBRATION_ID = [3, 6]
 
-def find_transformation_matrix(realsense_points, unity_points):
-    assert realsense_points.shape == unity_points.shape, "Point sets must have the same shape."
-    N = realsense_points.shape[0]
-    assert N >= 4, "At least 4 points are required."
-
-    # Prepare the design matrix A and the observation vector B
-    A = np.zeros((N * 3, 12))
-    B = np.zeros(N * 3)
-
-    for i in range(N):
-        x_r, y_r, z_r = realsense_points[i]
-        x_u, y_u, z_u = unity_points[i]
-
-        # Equation for x_u
-        A[3 * i] = [x_r, y_r, z_r, 1, 0, 0, 0, 0, 0, 0, 0, 0]
-        B[3 * i] = x_u
-
-        # Equation for y_u
-        A[3 * i + 1] = [0, 0, 0, 0, x_r, y_r, z_r, 1, 0, 0, 0, 0]
-        B[3 * i + 1] = y_u
-
-        # Equation for z_u
-        A[3 * i + 2] = [0, 0, 0, 0, 0, 0, 0, 0, x_r, y_r, z_r, 1]
-        B[3 * i + 2] = z_u
-
-    # Solve the linear system A * p = B
-    # p contains the elements of the transformation matrix T
-    p, _, _, _ = np.linalg.lstsq(A, B, rcond=None)
-
-    # Construct the transformation matrix T
-    T = np.zeros((4, 4))
-    T[0, :] = [p[0], p[1], p[2], p[3]]
-    T[1, :] = [p[4], p[5], p[6], p[7]]
-    T[2, :] = [p[8], p[9], p[10], p[11]]
-    T[3, :] = [0, 0, 0, 1]  # Homogeneous coordinate
-    return T
-
-def centroid(vertices):
-    x, y = 0, 0
-    n = len(vertices)
-    signed_area = 0
-    for i in range(len(vertices)):
-        x0, y0 = vertices[i]
-        x1, y1 = vertices[(i + 1) % n]
-        # shoelace formula
-        area = (x0 * y1) - (x1 * y0)
-        signed_area += area
-        x += (x0 + x1) * area
-        y += (y0 + y1) * area
-    signed_area *= 0.5
-    x /= 6 * signed_area
-    y /= 6 * signed_area
-    return int(x), int(y)
-
-def transform(T, L):
-    L.append(1)
-    x, y, z = np.matmul(T, np.array(L))[:-1].tolist()
-    return {'x': x, 'y': y, 'z': z}
+# Send extrapolated poses at this rate (Hz) from a background thread, e.g. the
+# headset refresh rate; None sends one filtered pose per processed frame
+PUBLISH_RATE = None
+
+# Send the responses over UDP to this port (no head-of-line blocking on a lossy
+# Wi-Fi, the calibration handshake stays on TCP); None sends them over TCP
+UDP_PORT = None
+
+# Send only the response fields that changed (more than 1 mm / 0.5 degree),
+# with a full keyframe every DELTA_KEYFRAME_EVERY responses; Unity must apply
+# them with the protocol.DeltaDecoder rules (over UDP a lost delta waits for the next keyframe)
+DELTA_MODE = False
+DELTA_KEYFRAME_EVERY = 30
+
+# Skeleton joint -> response field
+SKELETON_FIELDS = {
+    'Head': 'headPosition',
+    'LHand': 'leftHandPosition',
+    'RHand': 'rightHandPosition',
+    'LLeg': 'leftLegPosition',
+    'RLeg': 'rightLegPosition',
+}
 
 def main():
     T = None
+    calibration = None
     calibrated = False
 
     ###############  Configuration  ###############
 
-    # RealSense
-    pipeline = rs.pipeline()
-    config = rs.config()
-
-    pipeline_wrapper = rs.pipeline_wrapper(pipeline)
-    pipeline_profile = config.resolve(pipeline_wrapper)
-    device = pipeline_profile.get_device()    
-
-    found_rgb = False
-    for s in device.sensors:
-        if s.get_info(rs.camera_info.name) == 'RGB Camera':
-            found_rgb = True
-            break
-    if not found_rgb:
-        print("[main] The demo requires Depth camera with Color sensor")
-        exit(0)
-
-    config.enable_stream(rs.stream.depth, 1280, 720, rs.format.z16, 30)
-    config.enable_stream(rs.stream.color, 1280, 720, rs.format.bgr8, 30)
-
-    pipeline.start(config)
-    align_to = rs.stream.color
-    align = rs.align(align_to)
+    # RealSense (or a recorded session, see framesource.py)
+    source = open_source(1280, 720, 30, align='sparse')
 
     # ArUco
     arucoDict = cv2.aruco.getPredefinedDictionary(cv2.aruco.DICT_6X6_250)
     arucoParams = cv2.aruco.DetectorParameters()
     arucoDetector = cv2.aruco.ArucoDetector(arucoDict, arucoParams)
+    markerTracker = MarkerTracker(arucoDetector, rescan_every=30)
+
+    # MediaPipe (only the right side of the frame, where the NPC stands)
+    mp = MediaPipe(roi=(620, 0, 660, 720), target_latency=1 / 15, tracking=True)
+    mp.warm_up((720, 1280, 3))
 
-    # MediaPipe
-    mp = MediaPipe()
+    # Calibration, averaged over many frames off the frame loop (or the cached one if the anchor markers agree)
+    accumulator = CalibrationAccumulator(['Head', 'LHand', 'RHand'] + sorted(CALIBRATION_ID),
+                                         serial=source.serial, validate_keys=CALIBRATION_ID)
 
-    # Response
-    response_message = {
-        # Flags
+    # Joints and cart markers: filtered over time, then transformed to Unity together
+    names = list(SKELETON_FIELDS) + CART_ID
+    measured = PointBatch(names)
+    payload = PointBatch(names)
+    pose_filter = OneEuroFilter(len(names))
+    publisher = None
+
+    # Response flags, set by the frame loop in a single update() (build_response copies them)
+    response_flags = {
         'needsRefill': False,
         'isDangerous': False,
+        'hasSkeletonData': True,
+    }
 
+    # Last known positions, only used by build_response (on the frame loop, or on
+    # the publisher thread once it runs), kept when a joint or the cart is not seen
+    last_positions = {
         # NPC position
-        'hasSkeletonData': True,
         'headPosition': {'x': 0.0, 'y': 0.0, 'z': 0.0},
         'leftHandPosition': {'x': 0.0, 'y': 0.0, 'z': 0.0},
         'rightHandPosition': {'x': 0.0, 'y': 0.0, 'z': 0.0},
@@ -130,115 +102,118 @@ def main():
         'cartPosition': {'x': 0.0, 'y': 0.0, 'z': 0.0},
         'cartRotation': {'x': 0.0, 'y': 0.0, 'z': 0.0}
     }
+
+    def build_response(now):
+        "New response with the filtered poses extrapolated to now, shares no dict with earlier ones"
+        points, fresh = pose_filter.predict(now)
+        payload.set_all(points, fresh)
+        payload.transform(T)
+        positions = payload.vectors()
+        response = dict(response_flags)
+        if response['hasSkeletonData']:
+            for name, field in SKELETON_FIELDS.items():
+                if name in positions:
+                    last_positions[field] = positions[name]
+        for index, id in enumerate(CART_ID):
+            if id in positions:
+                last_positions['cartPosition'] = positions[id]
+                last_positions['cartRotation'] = {'x': 0.0, 'y': (index - 1) * 90.0, 'z': 0.0}
+        for field, vector in last_positions.items():
+            response[field] = dict(vector)
+        return response
+
+    # Delta mode: only what changed since the last response
+    delta = DeltaEncoder(DELTA_KEYFRAME_EVERY, epsilon=0.001, epsilons={'cartRotation': 0.5})
+
+    def publish(msg):
+        if DELTA_MODE:
+            msg = delta.encode(msg, connection.connections)
+            if msg is None:
+                return
+        send(connection, msg)
     
     try:
-        with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as sock:
-            sock.connect((HOST, PORT))
-            sock.setblocking(0)
-            print("connected")
+        # Unity connection, on its own I/O thread; with SERVE_PORT every Unity that connects gets the updates (see protocol.py)
+        with open_unity(HOST, PORT, SERVE_PORT, udp_port=UDP_PORT, udp_streams=['response']) as connection:
             # For every frame...
             while True:
                 # Wait for the depth and the color frame
-                frames = pipeline.wait_for_frames()
-                aligned_frames = align.process(frames)
-                depth_frame = aligned_frames.get_depth_frame()
-                color_frame = aligned_frames.get_color_frame()
-                if not depth_frame or not color_frame:
+                frame = source.read()
+                if frame is None:
+                    if source.exhausted:
+                        break
                     continue
-                depth_intrinsics = depth_frame.profile.as_video_stream_profile().intrinsics
-                color_image = np.asanyarray(color_frame.get_data())
-
-                modified_image = color_image
+                color_image = frame.color_image
 
-                white_image = np.ones_like(color_image) * 255
-                modified_image = white_image.copy()  # Start with a white image
-                modified_image[:720, 620:] = color_image[:720, 620:]  # Copy the top-left region
-
-                # Retrieve skeleton data
-                detection_results = mp.detect(modified_image)
-                modified_image = mp.draw_landmarks_on_image(modified_image, detection_results)
-                skeleton = mp.skeleton(modified_image, detection_results, depth_frame)
+                # Retrieve skeleton data (landmarks come back in full-frame coordinates)
+                detection_results = mp.detect(color_image)
+                skeleton = mp.skeleton(color_image, detection_results, frame)
 
                 if calibrated:
 
-                    ###############  NPC Skeleton  ###############
-
-                    if skeleton is None:
-                        response_message['hasSkeletonData'] = False
-                    else:
-                        response_message['hasSkeletonData'] = True
-                        response_message['headPosition'] = transform(T, [skeleton['Head_x'],  skeleton['Head_y'],  skeleton['Head_z']])
-                        response_message['leftHandPosition'] = transform(T, [skeleton['LHand_x'], skeleton['LHand_y'], skeleton['LHand_z']])
-                        response_message['rightHandPosition'] = transform(T, [skeleton['RHand_x'], skeleton['RHand_y'], skeleton['RHand_z']])
-                        response_message['leftLegPosition'] = transform(T, [skeleton['LLeg_x'], skeleton['LLeg_y'], skeleton['LLeg_z']])
-                        response_message['rightLegPosition'] = transform(T, [skeleton['RLeg_x'], skeleton['RLeg_y'], skeleton['RLeg_z']])
-
                     ###############  ArUco Code  ###############
 
                     # Decode ArUco coordinates
-                    aruco_coordinates = {}
-                    corners, ids, _ = arucoDetector.detectMarkers(color_image)
-                    for i in range(len(corners)):
-                        x, y = centroid(corners[i][0])
-                        depth = depth_frame.get_distance(x, y)
-                        aruco_coordinates[int(ids[i][0])] = rs.rs2_deproject_pixel_to_point(depth_intrinsics, [x, y], depth)
-
-                    # Get & transform cart coordinates
-                    for index, id in enumerate(CART_ID):
+                    corners, ids = markerTracker.detect(color_image)
+                    points = frame.deproject(polygon_centroids(corners))
+                    aruco_coordinates = {int(id): point for id, point in zip(np.ravel(ids), points.tolist())}
+
+                    # Refine the calibration from the anchor markers in view
+                    for id in CALIBRATION_ID:
                         if id in aruco_coordinates:
-                            response_message['cartPosition'] = transform(T, aruco_coordinates[id])
-                            response_message['cartRotation']['y'] = (index - 1) * 90.0
-                        else:
+                            calibration.observe(id, aruco_coordinates[id])
+                    if calibration.refine():
+                        T = calibration.T
+
+                    ###############  NPC Skeleton & Cart  ###############
+
+                    # Feed the measured joints (not the held ones) and cart markers to the filter
+                    measured.clear()
+                    if skeleton is not None:
+                        measured.set_skeleton(skeleton, skip=skeleton['missing'])
+                    measured.update({id: point for id, point in aruco_coordinates.items() if point[2] > 0})
+                    pose_filter.update(measured.points[:, :3], time.perf_counter(), measured.present)
+
+                    for id in CART_ID:
+                        if id not in aruco_coordinates:
                             print("[WARNING] Cart marker not found, using previous position.")
 
-                    response_message['needsRefill'] = any([id in aruco_coordinates for id in REFILL_ID])
+                    response_flags.update(hasSkeletonData=skeleton is not None,
+                                          needsRefill=any([id in aruco_coordinates for id in REFILL_ID]))
 
-                    send(sock, response_message)
+                    if publisher is None:
+                        publish(build_response(time.perf_counter()))
 
                         
-                elif skeleton is not None:
-                    # Not calibrated, but got skeleton info 
-                    # Should receive Unity coordinates to calibrate
+                else:
+                    # Not calibrated: collect samples, the accumulator solves T on its own thread
                     try:
-                        print("[INFO] Calibrating...")
-
-                        # Receive humanoid coordinates
-                        msg = receive(sock)
-                        unity_coordinates = [list(coor.values()) for coor in msg.values()]
-                        unity_coordinates_array = np.array(unity_coordinates)
-
-                        # Receive humanoid coordinates
-                        realsense_humanoid_coordinates = [
-                            [skeleton['Head_x'],  skeleton['Head_y'],  skeleton['Head_z']],
-                            [skeleton['LHand_x'], skeleton['LHand_y'], skeleton['LHand_z']],
-                            [skeleton['RHand_x'], skeleton['RHand_y'], skeleton['RHand_z']],
-                        ]
-
-                        # Decode ArUco coordinates
-                        realsense_aruco_coordinates = {}
-                        corners, ids, _ = arucoDetector.detectMarkers(color_image)
-                        for i in range(len(corners)):
-                            x, y = centroid(corners[i][0])
-                            depth = depth_frame.get_distance(x, y)
-                            realsense_aruco_coordinates[int(ids[i][0])] = rs.rs2_deproject_pixel_to_point(depth_intrinsics, [x, y], depth)
-                        realsense_aruco_coordinates = {key: realsense_aruco_coordinates[key] for key in CALIBRATION_ID if key in realsense_aruco_coordinates}
-                        if len(realsense_aruco_coordinates) < len(CALIBRATION_ID):
-                            print("[ERROR] Failed to calibrate: Not enough code.")
-                            continue
-                        if any(all(x == 0.0 for x in coordinate) for coordinate in realsense_aruco_coordinates.values()):
-                            print("[ERROR] Failed to calibrate: Invalid code coordinate.")
-                            continue
-                        realsense_aruco_coordinates = dict(sorted(realsense_aruco_coordinates.items()))
-                        realsense_aruco_coordinates = list(realsense_aruco_coordinates.values())
-                        
-                        # Start to compute T
-                        realsense_coordinates_array = np.array(realsense_humanoid_coordinates + realsense_aruco_coordinates)
-                        T = find_transformation_matrix(realsense_coordinates_array, unity_coordinates_array)
-                        calibrated = True
-                        print("[INFO] Calibration done.")
-                        
+                        # Unity coordinates of the humanoid and the anchors (Head, LHand, RHand, markers)
+                        msg = receive(connection)
+                        accumulator.set_targets([list(coor.values()) for coor in msg.values()])
+                    except BlockingIOError:
+                        pass
                     except Exception as error :
-                        print("[ERROR] Failed to calibrate:", type(error).__name__, "-", error)
+                        print("[ERROR] Failed to receive calibration targets:", type(error).__name__, "-", error)
+
+                    samples = {}
+                    if skeleton is not None:
+                        for name in ('Head', 'LHand', 'RHand'):
+                            if name not in skeleton['missing']:
+                                samples[name] = [skeleton[name + '_x'], skeleton[name + '_y'], skeleton[name + '_z']]
+                    corners, ids = markerTracker.detect(color_image)
+                    points = frame.deproject(polygon_centroids(corners))
+                    samples.update({int(id): point for id, point in zip(np.ravel(ids), points.tolist())})
+                    accumulator.add(samples)
+
+                    if accumulator.ready.is_set():
+                        # Anchor markers keep refining it while streaming
+                        calibration = accumulator.calibration
+                        T = calibration.T
+                        calibrated = True
+                        print(f"[INFO] Calibration done ({accumulator.source}):", calibration.stats())
+                        if PUBLISH_RATE:
+                            publisher = PosePublisher(build_response, publish, PUBLISH_RATE)
 
                 # Show images for every frames
                 cv2.namedWindow('RealSense', cv2.WINDOW_AUTOSIZE)
@@ -247,20 +222,22 @@ def main():
 
 
     finally:
+        # Keep the (refined) calibration for the next run
+        if calibration is not None:
+            save_calibration(calibration, source.serial)
         # Stop streaming
-        pipeline.stop()
-
-def receive(sock):
-    data = sock.recv(8192)
-    data = data.decode('utf-8')
-    print("Received:", data)
-    msg = json.loads(data)
+        if publisher is not None:
+            publisher.stop()
+        accumulator.stop()
+        source.stop()
+
+def receive(connection):
+    msg = connection.receive()
+    print("Received:", msg)
     return msg
 
-def send(sock, msg):
-    data = json.dumps(msg)
-    sock.sendall(data.encode('utf-8'))
-    print("Sent:", msg)
+def send(connection, msg):
+    connection.send(msg, stream='response')
 
 if __name__ == '__main__':
     main()
\ No newline at end of file
@@ -1,98 +1,375 @@
-'''
-Reference:
-google-ai-edge / mediapipe
-https://chuoling.github.io/mediapipe/solutions/holistic.html
-https://github.com/google-ai-edge/mediapipe/tree/master
-https://github.com/google-ai-edge/mediapipe/blob/master/docs/solutions/pose.md
-'''
-import mediapipe as mp
-import cv2
-import numpy as np
-import pyrealsense2 as rs
-
-class MediaPipe:
-    def __init__(self):
-        self.mp_drawing = mp.solutions.drawing_utils          # mediapipe drawing
-        self.mp_drawing_styles = mp.solutions.drawing_styles  # mediapipe drawing style
-        self.mp_holistic = mp.solutions.holistic                     # mediapipe pose detection
-        self.holistic = self.mp_holistic.Holistic(
-            static_image_mode=True,
-            model_complexity=2,
-            enable_segmentation=True,
-            refine_face_landmarks=True)
-
-    def detect(self, frame):
-        return self.holistic.process(cv2.cvtColor(frame, cv2.COLOR_BGR2RGB))
-
-    def draw_landmarks_on_image(self, rgb_image, detection_result):
-        "Draw skeleton on image"
-        annotated_image = np.copy(rgb_image)
-        self.mp_drawing.draw_landmarks(
-            annotated_image,
-            detection_result.face_landmarks,
-            self.mp_holistic.FACEMESH_TESSELATION,
-            landmark_drawing_spec=None,
-            connection_drawing_spec=self.mp_drawing_styles.get_default_face_mesh_tesselation_style())
-        self.mp_drawing.draw_landmarks(
-            annotated_image,
-            detection_result.pose_landmarks,
-            self.mp_holistic.POSE_CONNECTIONS,
-            landmark_drawing_spec=self.mp_drawing_styles.get_default_pose_landmarks_style())
-        return annotated_image
-    
-    def print_result(self, image, results):
-        "Print LEFT_SHOULDER pixel coordinates"
-        image_height, image_width, _ = image.shape
-        if results.pose_landmarks:
-            print(f'Left Shoulder coordinates: ('
-                f'{results.pose_landmarks.landmark[self.mp_holistic.PoseLandmark.LEFT_SHOULDER].x * image_width}, '
-                f'{results.pose_landmarks.landmark[self.mp_holistic.PoseLandmark.LEFT_SHOULDER].y * image_height})'
-            )
-
-    def point_to_3D(self, landmark, image, depth_frame):
-        "Convert Pixel coordinates to RealSense 3D coordinates"
-        depth_intrinsics = depth_frame.profile.as_video_stream_profile().intrinsics
-        image_height, image_width, _ = image.shape
-        x = int(landmark.x * image_width)
-        x = min(image_width-1, max(x, 0))
-        y = int(landmark.y * image_height)
-        y = min(image_height-1, max(y, 0))
-        depth = depth_frame.get_distance(x, y)
-        return rs.rs2_deproject_pixel_to_point(depth_intrinsics, [x, y], depth) if depth > 0 else None
-    
-    def skeleton(self, image, results, depth_frame):
-        if results.pose_landmarks is None:
-            return None
-        
-        head3D = self.point_to_3D(results.pose_landmarks.landmark[self.mp_holistic.PoseLandmark.NOSE], image, depth_frame)
-        if head3D is None:
-            return None
-        Head_x, Head_y, Head_z = head3D
-
-        rWrist3D =  self.point_to_3D(results.pose_landmarks.landmark[self.mp_holistic.PoseLandmark.RIGHT_WRIST], image, depth_frame)
-        if rWrist3D is None:
-            return None
-        RHand_x, RHand_y, RHand_z = rWrist3D
-
-        lWrist3D = self.point_to_3D(results.pose_landmarks.landmark[self.mp_holistic.PoseLandmark.LEFT_WRIST], image, depth_frame)
-        if lWrist3D is None:
-            return None
-        LHand_x, LHand_y, LHand_z = lWrist3D
-
-        rAnkle3D =  self.point_to_3D(results.pose_landmarks.landmark[self.mp_holistic.PoseLandmark.RIGHT_ANKLE], image, depth_frame)
-        if rAnkle3D is None:
-            return None
-        RLeg_x, RLeg_y, RLeg_z = rAnkle3D
-
-        lAnkle3D = self.point_to_3D(results.pose_landmarks.landmark[self.mp_holistic.PoseLandmark.LEFT_ANKLE], image, depth_frame)
-        if lAnkle3D is None:
-            return None
-        LLeg_x, LLeg_y, LLeg_z = lAnkle3D
-
-        msg = {'LHand_x': LHand_x, 'LHand_y': LHand_y, 'LHand_z': LHand_z,
-                'RHand_x': RHand_x, 'RHand_y': RHand_y, 'RHand_z': RHand_z,
-                'LLeg_x': LLeg_x, 'LLeg_y': LLeg_y, 'LLeg_z': LLeg_z,
-                'RLeg_x': RLeg_x, 'RLeg_y': RLeg_y, 'RLeg_z': RLeg_z,
-                'Head_x': Head_x, 'Head_y': Head_y, 'Head_z': Head_z,}
-        
-        return msg
\ No newline at end of file
+'''
+Reference:
+google-ai-edge / mediapipe
+https://chuoling.github.io/mediapipe/solutions/holistic.html
+https://github.com/google-ai-edge/mediapipe/tree/master
+https://github.com/google-ai-edge/mediapipe/blob/master/docs/solutions/pose.md
+'''
+import threading
+import time
+import cv2
+import numpy as np
+
+mp = None   # mediapipe, imported on first use because the import alone takes seconds
+
+
+def import_mediapipe():
+    global mp
+    if mp is None:
+        import mediapipe
+        mp = mediapipe
+    return mp
+
+
+# Skeleton joints sent to Unity: (message name, pose landmark)
+SKELETON_JOINTS = (('LHand', 'LEFT_WRIST'), ('RHand', 'RIGHT_WRIST'),
+                   ('LLeg', 'LEFT_ANKLE'), ('RLeg', 'RIGHT_ANKLE'), ('Head', 'NOSE'))
+
+
+class BufferPool:
+    "Fixed-shape arrays handed out per frame and returned for reuse"
+    def __init__(self):
+        self.free = {}          # (shape, dtype) -> arrays ready for reuse
+        self.allocations = 0
+        self.lock = threading.Lock()
+
+    def get(self, shape, dtype=np.uint8):
+        with self.lock:
+            free = self.free.get((tuple(shape), np.dtype(dtype)))
+            if free:
+                return free.pop()
+            self.allocations += 1
+        print(f"[INFO] Buffer pool: allocated {tuple(shape)} {np.dtype(dtype)} ({self.allocations} total)")
+        return np.empty(shape, dtype)
+
+    def put(self, array):
+        with self.lock:
+            self.free.setdefault((array.shape, array.dtype), []).append(array)
+
+    def stats(self):
+        return {'allocations': self.allocations,
+                'free': sum(len(arrays) for arrays in self.free.values())}
+
+
+# Quality levels for the LatencyController, best first:
+# (model_complexity, static_image_mode, inference scale)
+LEVELS = [
+    (2, True,  1.0),
+    (2, False, 1.0),
+    (1, False, 1.0),
+    (1, False, 0.75),
+    (0, False, 0.75),
+    (0, False, 0.5),
+]
+
+
+class LatencyController:
+    '''
+    Hold inference latency under a target by stepping through LEVELS.
+    Steps to a cheaper level once the smoothed latency has been over budget for
+    `patience` frames, and back to a better one only after `recovery` frames
+    under headroom * target. The gap between the two (hysteresis) and the
+    reset after every change keep it from oscillating between two levels.
+    It never goes above LEVELS[best].
+    '''
+    def __init__(self, target, level, patience=10, recovery=90, headroom=0.6, smoothing=0.2, best=0):
+        self.target = target
+        self.level = level
+        self.best = best
+        self.patience = patience
+        self.recovery = recovery
+        self.headroom = headroom
+        self.smoothing = smoothing
+        self.reset()
+
+    def reset(self):
+        self.latency = None
+        self.over = 0
+        self.under = 0
+
+    def update(self, latency):
+        "Feed one inference latency (seconds), returns the new level when it changes"
+        if self.latency is None:
+            self.latency = latency
+        else:
+            self.latency += self.smoothing * (latency - self.latency)
+        self.over = self.over + 1 if self.latency > self.target else 0
+        self.under = self.under + 1 if self.latency < self.headroom * self.target else 0
+
+        if self.over >= self.patience and self.level < len(LEVELS) - 1:
+            self.level += 1
+        elif self.under >= self.recovery and self.level > self.best:
+            self.level -= 1
+        else:
+            return None
+        self.reset()
+        return self.level
+
+
+class TrackingScheduler:
+    '''
+    Re-detection for MediaPipe in tracking mode (static_image_mode=False).
+    MediaPipe only runs the landmark model on a crop around the previous pose
+    and re-detects by itself once it loses the pose. A pose it still tracks,
+    but badly (the tracked joints' mean visibility under min_visibility), is
+    dropped with a graph reset so the next frame runs the person detector.
+    There is no periodic detection, and at most one reset every cooldown
+    frames, so a person partly out of view does not restart the graph on
+    every frame.
+    '''
+    def __init__(self, joints, min_visibility=0.5, cooldown=15):
+        self.joints = joints
+        self.min_visibility = min_visibility
+        self.cooldown = cooldown
+        self.force = False
+        self.since_reset = cooldown
+        self.visibility = 1.0
+        self.frames = 0
+        self.resets = 0             # graph resets forced for a re-detection
+        self.reset_time = 0.0       # seconds spent in them
+
+    def due(self):
+        "Whether the tracked pose must be dropped before the next frame"
+        return self.force and self.since_reset >= self.cooldown
+
+    def update(self, pose_landmarks, reset):
+        self.frames += 1
+        self.since_reset = 0 if reset else self.since_reset + 1
+        if pose_landmarks is None:
+            # MediaPipe re-detects by itself once the pose is lost
+            self.force = False
+            return
+        landmarks = pose_landmarks.landmark
+        self.visibility = float(np.mean([landmarks[i].visibility for i in self.joints]))
+        self.force = self.visibility < self.min_visibility
+
+    def stats(self):
+        return {'frames': self.frames, 'visibility': round(self.visibility, 3),
+                'resets': self.resets, 'reset_ms': round(self.reset_time / max(self.resets, 1) * 1000, 2)}
+
+
+class MediaPipe:
+    def __init__(self, roi=None, target_latency=None, tracking=False, depth_radius=2, hold_frames=5):
+        '''
+        target_latency (seconds) lets a LatencyController trade model quality for speed
+        tracking=True switches to tracking mode, re-detecting only when the tracked pose degrades (TrackingScheduler)
+        depth_radius / hold_frames control how skeleton() deals with depth holes at the joints
+        '''
+        import_mediapipe()
+        self.roi = roi                                        # (x, y, width, height) or None for full frame
+        self.mp_drawing = mp.solutions.drawing_utils          # mediapipe drawing
+        self.mp_drawing_styles = mp.solutions.drawing_styles  # mediapipe drawing style
+        self.pool = BufferPool()                              # per-frame image buffers
+        self.mp_holistic = mp.solutions.holistic                     # mediapipe pose detection
+        self.level = None
+        self.scheduler = None
+        self.depth_radius = depth_radius
+        self.hold_frames = hold_frames
+        self.joints = {}                                      # joint name -> (last 3D position, frames held)
+        if not tracking:
+            self.load(LEVELS.index((2, True, 1.0)))
+        else:
+            # Static mode would detect on every frame, keep the controller in tracking levels
+            self.load(LEVELS.index((2, False, 1.0)))
+            PoseLandmark = self.mp_holistic.PoseLandmark
+            self.scheduler = TrackingScheduler([PoseLandmark.NOSE, PoseLandmark.LEFT_WRIST, PoseLandmark.RIGHT_WRIST,
+                                                PoseLandmark.LEFT_ANKLE, PoseLandmark.RIGHT_ANKLE])
+        self.controller = LatencyController(target_latency, self.level, best=self.level) if target_latency is not None else None
+
+    def load(self, level):
+        "Switch to a quality level, rebuilding the graph only if the model settings change (returns True then)"
+        model_complexity, static_image_mode, _ = LEVELS[level]
+        previous = LEVELS[self.level] if self.level is not None else None
+        self.level = level
+        if previous is not None:
+            if previous[:2] == (model_complexity, static_image_mode):
+                return False
+            self.holistic.close()
+        self.holistic = self.mp_holistic.Holistic(
+            static_image_mode=static_image_mode,
+            model_complexity=model_complexity,
+            enable_segmentation=True,
+            refine_face_landmarks=True)
+        return True
+
+    def detect(self, frame):
+        '''
+        Detect on the whole frame, or on self.roi only.
+        With a ROI, landmarks are remapped to full-frame coordinates (the
+        segmentation mask still covers the ROI only, at inference resolution).
+        '''
+        full_shape = frame.shape
+        if self.roi is not None:
+            x, y, w, h = self.roi
+            frame = frame[y:y + h, x:x + w]
+        height, width, _ = frame.shape
+        scale = LEVELS[self.level][2]
+        if scale != 1.0:
+            small = self.pool.get((int(height * scale), int(width * scale), 3))
+            cv2.resize(frame, (small.shape[1], small.shape[0]), dst=small, interpolation=cv2.INTER_AREA)
+            rgb_image = self.pool.get(small.shape)
+            cv2.cvtColor(small, cv2.COLOR_BGR2RGB, dst=rgb_image)
+            self.pool.put(small)
+        else:
+            rgb_image = self.pool.get(frame.shape)
+            cv2.cvtColor(frame, cv2.COLOR_BGR2RGB, dst=rgb_image)
+        reset = self.scheduler is not None and self.scheduler.due()
+        if reset:
+            # Drop the badly tracked pose, this frame runs the person detector.
+            # Timed apart: the controller only sees the inference itself
+            start = time.perf_counter()
+            self.holistic.reset()
+            self.scheduler.resets += 1
+            self.scheduler.reset_time += time.perf_counter() - start
+        start = time.perf_counter()
+        try:
+            results = self.holistic.process(rgb_image)
+        finally:
+            self.pool.put(rgb_image)
+        latency = time.perf_counter() - start
+        if self.roi is not None:
+            self.remap(results, frame.shape, full_shape)
+        if self.scheduler is not None:
+            self.scheduler.update(results.pose_landmarks, reset)
+
+        if self.controller is not None:
+            level = self.controller.update(latency)
+            if level is not None:
+                print(f"[INFO] Inference took {latency * 1000:.0f} ms, switching to quality level {level} {LEVELS[level]}")
+                if self.load(level):
+                    # Initialize the new graph now, so its cold start is not measured on the next frame
+                    self.warm_up(full_shape)
+        return results
+
+    def warm_up(self, shape):
+        "Run the graph once on a blank frame so the first real frame does not pay its initialization"
+        if self.roi is not None:
+            shape = (self.roi[3], self.roi[2], 3)
+        self.holistic.process(np.zeros(shape, np.uint8))
+        self.holistic.reset()
+
+    def remap(self, results, roi_shape, full_shape):
+        "Convert landmarks normalized to the ROI into landmarks normalized to the full frame"
+        x, y, _, _ = self.roi
+        h, w = roi_shape[:2]
+        full_height, full_width = full_shape[:2]
+        for landmarks in (results.pose_landmarks, results.face_landmarks,
+                          results.left_hand_landmarks, results.right_hand_landmarks):
+            if landmarks is None:
+                continue
+            for landmark in landmarks.landmark:
+                landmark.x = (x + landmark.x * w) / full_width
+                landmark.y = (y + landmark.y * h) / full_height
+
+    def draw_landmarks_on_image(self, rgb_image, detection_result, in_place=False):
+        '''
+        Draw skeleton on image
+        in_place=True draws on rgb_image itself (the caller owns it), otherwise the
+        skeleton is drawn on a pool buffer the caller returns with self.pool.put()
+        '''
+        if in_place:
+            annotated_image = rgb_image
+        else:
+            annotated_image = self.pool.get(rgb_image.shape)
+            np.copyto(annotated_image, rgb_image)
+        self.mp_drawing.draw_landmarks(
+            annotated_image,
+            detection_result.face_landmarks,
+            self.mp_holistic.FACEMESH_TESSELATION,
+            landmark_drawing_spec=None,
+            connection_drawing_spec=self.mp_drawing_styles.get_default_face_mesh_tesselation_style())
+        self.mp_drawing.draw_landmarks(
+            annotated_image,
+            detection_result.pose_landmarks,
+            self.mp_holistic.POSE_CONNECTIONS,
+            landmark_drawing_spec=self.mp_drawing_styles.get_default_pose_landmarks_style())
+        return annotated_image
+    
+    def print_result(self, image, results):
+        "Print LEFT_SHOULDER pixel coordinates"
+        image_height, image_width, _ = image.shape
+        if results.pose_landmarks:
+            print(f'Left Shoulder coordinates: ('
+                f'{results.pose_landmarks.landmark[self.mp_holistic.PoseLandmark.LEFT_SHOULDER].x * image_width}, '
+                f'{results.pose_landmarks.landmark[self.mp_holistic.PoseLandmark.LEFT_SHOULDER].y * image_height})'
+            )
+
+    def landmarks_to_3D(self, landmarks, indices, image, depth_frame, radius=0):
+        '''
+        (N, 3) RealSense 3D coordinates of landmarks[indices], one vectorized lookup (depth 0 -> z 0)
+        radius > 0 uses the median depth of a patch around every landmark (see Frame.get_distances)
+        '''
+        image_height, image_width, _ = image.shape
+        pixels = np.array([(landmarks[i].x * image_width, landmarks[i].y * image_height) for i in indices])
+        return depth_frame.deproject(pixels, radius)
+
+    def point_to_3D(self, landmark, image, depth_frame):
+        "Convert Pixel coordinates to RealSense 3D coordinates"
+        point = self.landmarks_to_3D([landmark], [0], image, depth_frame)[0]
+        return point.tolist() if point[2] > 0 else None
+    
+    def skeleton(self, image, results, depth_frame):
+        '''
+        3D joints for Unity, or None without a pose.
+        Each joint takes the median depth around it (depth_radius). A joint that
+        still has no depth keeps its last position for up to hold_frames frames
+        and is listed in msg['missing'], the frame is only dropped after that.
+        Held joints are forgotten as soon as a frame has no pose.
+        '''
+        if results.pose_landmarks is None:
+            # Never hold a joint across frames without a person
+            self.joints.clear()
+            return None
+
+        # All joints in one depth lookup + deprojection
+        indices = [self.mp_holistic.PoseLandmark[landmark] for _, landmark in SKELETON_JOINTS]
+        points = self.landmarks_to_3D(results.pose_landmarks.landmark, indices, image, depth_frame, self.depth_radius)
+
+        msg = {}
+        missing = []
+        for (name, _), point, valid in zip(SKELETON_JOINTS, points.tolist(), points[:, 2] > 0):
+            if valid:
+                self.joints[name] = (point, 0)
+            else:
+                last = self.joints.get(name)
+                if last is None or last[1] >= self.hold_frames:
+                    return None
+                point = last[0]
+                self.joints[name] = (point, last[1] + 1)
+                missing.append(name)
+            msg[name + '_x'], msg[name + '_y'], msg[name + '_z'] = point
+        msg['missing'] = missing
+        return msg
+
+
+def compare_tracking(count=300):
+    '''
+    Per-frame detect() time with visibility-triggered re-detection against
+    plain tracking mode (no scheduler), on the first count frames of the
+    source chosen by open_source (set RSREPLAY to compare both on the same
+    recording)
+    '''
+    from framesource import open_source
+    source = open_source(640, 480, 30)
+    frames = [frame.color_image.copy() for _, frame in zip(range(count), source)]
+    source.stop()
+    for name in ('re-detect', 'tracking'):
+        mp = MediaPipe(tracking=True)
+        if name == 'tracking':
+            mp.scheduler = None
+        mp.warm_up(frames[0].shape)
+        times = []
+        for image in frames:
+            start = time.perf_counter()
+            mp.detect(image)
+            times.append(time.perf_counter() - start)
+        times = np.array(times) * 1000
+        stats = mp.scheduler.stats() if mp.scheduler is not None else {}
+        print(f"[INFO] {name}: mean {times.mean():.1f} ms, p95 {np.percentile(times, 95):.1f} ms, max {times.max():.1f} ms", stats)
+
+
+if __name__ == '__main__':
+    import os
+    import sys
+    sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'common'))
+    compare_tracking()
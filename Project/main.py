@@ -1,103 +1,107 @@
+import time
+import os
+import sys
+from concurrent.futures import ThreadPoolExecutor
 import cv2
-import numpy as np
-import pyrealsense2 as rs
 from flask import Flask, Response, request, jsonify
 from flask_socketio import SocketIO
-from mpipe import MediaPipe
+# Modules shared by the labs and the project (framesource, calibration, protocol...) live in common/
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'common'))
+from mpipe import MediaPipe, InferencePool
+from framesource import open_source, ThreadedSource
+from outline import Outline
 
 
 USE_REALSENSE = True
 HOST, PORT = "127.0.0.1", 5000
 WIDTH, HEIGHT, FPS = 1280, 720, 30
+INFERENCE_WORKERS = 4       # MediaPipe worker processes, 0 runs MediaPipe in the request thread
+MAX_IN_FLIGHT = 4           # frames queued for inference at most (caps latency)
+ORDERED = True              # yield every inferred frame in order, False: only the newest (latest wins)
+TARGET_LATENCY = 1 / 10     # seconds per inference, MediaPipe lowers its quality to stay under it
+OUTLINE_SCALE = 0.25        # resolution the outline is traced at, relative to the video
+OUTLINE_DEPTH = False       # default of /video_feed?depth=, keep only the outline within Frame.mask_range
 
 latest_results = None
+source = None               # camera, set up in main
+mp = None                   # drawing (and inference when INFERENCE_WORKERS == 0)
+detector = None             # mp or an InferencePool
 
 
 ###############  Configuration  ###############
 
-# Camera
-if USE_REALSENSE:
-    pipeline = rs.pipeline()
-    config = rs.config()
-    pipeline_wrapper = rs.pipeline_wrapper(pipeline)
-    pipeline_profile = config.resolve(pipeline_wrapper)
-    device = pipeline_profile.get_device()
-    found_rgb = False
-    for s in device.sensors:
-        if s.get_info(rs.camera_info.name) == 'RGB Camera':
-            found_rgb = True
-            break
-    if not found_rgb:
-        print("[main] The demo requires Depth camera with Color sensor")
-        exit(0)
-    config.enable_stream(rs.stream.depth, WIDTH, HEIGHT, rs.format.z16, FPS)
-    config.enable_stream(rs.stream.color, WIDTH, HEIGHT, rs.format.bgr8, FPS)
-    pipeline.start(config)
-    align = rs.align(rs.stream.color)
-else:
-    cap = cv2.VideoCapture(0)
-    cap.set(cv2.CAP_PROP_FRAME_WIDTH, WIDTH)
-    cap.set(cv2.CAP_PROP_FRAME_HEIGHT, HEIGHT)
-    cap.set(cv2.CAP_PROP_FPS, FPS)
-
 # Flask
 app = Flask(__name__)
 socketio = SocketIO(app)
 
-# MediaPipe
-mp = MediaPipe(use_holistic=False)
+
+def timed(timings, name, function, *args, **kwargs):
+    start = time.perf_counter()
+    result = function(*args, **kwargs)
+    timings[name] = time.perf_counter() - start
+    return result
+
+
+def open_camera():
+    # Camera (set RSREPLAY / RSRECORD to replay or record a session, see framesource.py)
+    # Capture runs on its own thread, inference always takes the newest frame
+    # (every frame, in order, when replaying with RSREPLAY_FAST=1).
+    # Depth is aligned to color only when frame.depth_image is read (see SparseFrame)
+    return ThreadedSource(open_source(WIDTH, HEIGHT, FPS, align='sparse', use_realsense=USE_REALSENSE))
+
+
+def load_models(timings):
+    "MediaPipe for drawing, plus the model(s), warmed up on a blank frame before we serve anything"
+    mp = timed(timings, 'mediapipe', MediaPipe, use_holistic=False,
+               inference=INFERENCE_WORKERS == 0, target_latency=TARGET_LATENCY)
+    if INFERENCE_WORKERS > 0:
+        detector = InferencePool(use_holistic=False, shape=(HEIGHT, WIDTH, 3),
+                                 workers=INFERENCE_WORKERS, max_in_flight=MAX_IN_FLIGHT,
+                                 target_latency=TARGET_LATENCY)
+        timed(timings, 'workers', detector.wait_ready)
+    else:
+        detector = mp
+        timed(timings, 'warm-up', mp.warm_up, (HEIGHT, WIDTH, 3))
+    return mp, detector
+
+
+def setup():
+    "Open the camera and load the models concurrently (only in the main process, workers import this module)"
+    global source, mp, detector
+    start = time.perf_counter()
+    timings = {}
+    with ThreadPoolExecutor(max_workers=2) as executor:
+        camera = executor.submit(timed, timings, 'camera', open_camera)
+        models = executor.submit(load_models, timings)
+        source = camera.result()
+        mp, detector = models.result()
+    timings['total'] = time.perf_counter() - start
+    print("[INFO] Startup:", ", ".join(f"{name} {seconds:.2f} s" for name, seconds in timings.items()))
 
 
 ###############  Functions  ###############
 
-def generate_frames(outline: bool = False):
+def generate_frames(outline: bool = False, depth_gated: bool = OUTLINE_DEPTH):
     global latest_results
+    outline_cache = Outline(scale=OUTLINE_SCALE)
     try:
-        while True:
-            # Wait for the depth and the color frame
-            if USE_REALSENSE:
-                # RealSense: Wait for the depth and the color frame
-                frames = pipeline.wait_for_frames()
-                aligned_frames = align.process(frames)
-                color_frame = aligned_frames.first(rs.stream.color)
-                depth_frame = aligned_frames.get_depth_frame()
-                if not color_frame or not depth_frame:
-                    continue
-                color_image = np.asanyarray(color_frame.get_data())
-                depth_image = np.asanyarray(depth_frame.get_data())
-                depth_mask = depth_image.astype(np.uint8)
-            else:
-                # Webcam: Capture frames
-                ret, color_image = cap.read()
-                if not ret:
-                    continue
-
-            # Retrieve skeleton data
-            detection_results = mp.detect(color_image)
+        # Take the newest frames and retrieve their skeleton data
+        for frame, detection_results in detector.stream(source, ORDERED):
+            color_image = frame.color_image
             latest_results = detection_results
 
-            # Draw landmarks on image
+            # Draw landmarks on a pool buffer (the captured frame is shared with other clients)
             color_image = mp.draw_landmarks_on_image(color_image, detection_results)
 
             if outline and detection_results.segmentation_mask is not None:
-                # Convert the segmentation mask to binary mask
-                segmentation_mask = detection_results.segmentation_mask
-                # Threshold the mask to create a binary image
-                mask = (segmentation_mask > 0.1).astype(np.uint8) * 255
-
-                if False:
-                    kernel = np.ones((5, 5), np.uint8)
-                    mask = cv2.bitwise_and(mask, depth_mask)
-                    mask = cv2.morphologyEx(mask, cv2.MORPH_OPEN, kernel)
-                    mask = cv2.morphologyEx(mask, cv2.MORPH_CLOSE, kernel)
-                    
-                # Find contours on the mask
-                contours, _ = cv2.findContours(mask, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE)
-
-                # Draw contours on the color image
-                cv2.drawContours(color_image, contours, -1, (255, 255, 255), 2)
+                # Gate the person by depth (aligning the depth frame, once per frame for all clients)
+                depth_mask = frame.depth_mask if depth_gated and source.has_depth else None
+
+                # Trace the mask at low resolution (reusing the last contours if it barely moved) and draw it
+                outline_cache.draw(color_image, detection_results.segmentation_mask, depth_mask)
 
             _, buffer = cv2.imencode('.jpg', color_image)
+            mp.pool.put(color_image)
 
             # Convert image to bytes
             color_image = buffer.tobytes()
@@ -113,7 +117,8 @@ def generate_frames(outline: bool = False):
 @app.route('/video_feed')
 def video_feed():
     outline = request.args.get('outline') == 'true'
-    return Response(generate_frames(outline), mimetype='multipart/x-mixed-replace; boundary=frame')
+    depth_gated = request.args.get('depth', str(OUTLINE_DEPTH).lower()) == 'true'
+    return Response(generate_frames(outline, depth_gated), mimetype='multipart/x-mixed-replace; boundary=frame')
 
 
 @app.route('/nodes', methods=['GET'])
@@ -134,13 +139,24 @@ def get_nodes():
         return jsonify({"error": str(e)}), 500
 
 
+@app.route('/stats', methods=['GET'])
+def get_stats():
+    "Capture counters (frames captured, served, dropped, age of the last one) and buffer pool allocations"
+    stats = {**source.stats(), 'buffers': mp.pool.stats()}
+    if isinstance(detector, InferencePool):
+        stats['inference'] = detector.stats()
+    return jsonify(stats)
+
+
 ###############  Main  ###############
 
 if __name__ == '__main__':
+    setup()
     try:
         socketio.run(app, host=HOST, port=PORT)
         # pipeline.start(config)
     finally:
-        if USE_REALSENSE:
-            # Stop the pipeline when the script ends
-            pipeline.stop()
\ No newline at end of file
+        # Stop the camera and the inference workers when the script ends
+        source.stop()
+        if detector is not mp:
+            detector.stop()
\ No newline at end of file
@@ -5,39 +5,216 @@ https://chuoling.github.io/mediapipe/solutions/holistic.html
 https://github.com/google-ai-edge/mediapipe/tree/master
 https://github.com/google-ai-edge/mediapipe/blob/master/docs/solutions/pose.md
 '''
-import mediapipe as mp
+import multiprocessing
+import threading
+import time
+from collections import deque
+from multiprocessing import shared_memory
+from types import SimpleNamespace
 import cv2
 import numpy as np
-import pyrealsense2 as rs
+
+mp = None   # mediapipe, imported on first use because the import alone takes seconds
+
+
+def import_mediapipe():
+    global mp
+    if mp is None:
+        import mediapipe
+        mp = mediapipe
+    return mp
+
+
+class BufferPool:
+    "Fixed-shape arrays handed out per frame and returned for reuse"
+    def __init__(self):
+        self.free = {}          # (shape, dtype) -> arrays ready for reuse
+        self.allocations = 0
+        self.lock = threading.Lock()
+
+    def get(self, shape, dtype=np.uint8):
+        with self.lock:
+            free = self.free.get((tuple(shape), np.dtype(dtype)))
+            if free:
+                return free.pop()
+            self.allocations += 1
+        print(f"[INFO] Buffer pool: allocated {tuple(shape)} {np.dtype(dtype)} ({self.allocations} total)")
+        return np.empty(shape, dtype)
+
+    def put(self, array):
+        with self.lock:
+            self.free.setdefault((array.shape, array.dtype), []).append(array)
+
+    def stats(self):
+        return {'allocations': self.allocations,
+                'free': sum(len(arrays) for arrays in self.free.values())}
+
+
+# Quality levels for the LatencyController, best first:
+# (model_complexity, static_image_mode, inference scale)
+LEVELS = [
+    (2, True,  1.0),
+    (2, False, 1.0),
+    (1, False, 1.0),
+    (1, False, 0.75),
+    (0, False, 0.75),
+    (0, False, 0.5),
+]
+
+
+class LatencyController:
+    '''
+    Hold inference latency under a target by stepping through LEVELS.
+    Steps to a cheaper level once the smoothed latency has been over budget for
+    `patience` frames, and back to a better one only after `recovery` frames
+    under headroom * target. The gap between the two (hysteresis) and the
+    reset after every change keep it from oscillating between two levels.
+    It never goes above LEVELS[best].
+    '''
+    def __init__(self, target, level, patience=10, recovery=90, headroom=0.6, smoothing=0.2, best=0):
+        self.target = target
+        self.level = level
+        self.best = best
+        self.patience = patience
+        self.recovery = recovery
+        self.headroom = headroom
+        self.smoothing = smoothing
+        self.reset()
+
+    def reset(self):
+        self.latency = None
+        self.over = 0
+        self.under = 0
+
+    def update(self, latency):
+        "Feed one inference latency (seconds), returns the new level when it changes"
+        if self.latency is None:
+            self.latency = latency
+        else:
+            self.latency += self.smoothing * (latency - self.latency)
+        self.over = self.over + 1 if self.latency > self.target else 0
+        self.under = self.under + 1 if self.latency < self.headroom * self.target else 0
+
+        if self.over >= self.patience and self.level < len(LEVELS) - 1:
+            self.level += 1
+        elif self.under >= self.recovery and self.level > self.best:
+            self.level -= 1
+        else:
+            return None
+        self.reset()
+        return self.level
+
 
 class MediaPipe:
-    def __init__(self, use_holistic):
+    def __init__(self, use_holistic, inference=True, target_latency=None):
+        '''
+        inference=False only loads the drawing helpers (detection runs in an InferencePool)
+        target_latency (seconds) lets a LatencyController trade model quality for speed
+        '''
+        import_mediapipe()
         self.use_holistic = use_holistic
         self.mp_drawing = mp.solutions.drawing_utils          # mediapipe drawing
         self.mp_drawing_styles = mp.solutions.drawing_styles  # mediapipe drawing style
+        self.pool = BufferPool()                              # per-frame image buffers
         if (self.use_holistic):
             self.mp_holistic = mp.solutions.holistic
+        else:
+            self.mp_pose = mp.solutions.pose
+        self.level = None
+        self.controller = None
+        if inference:
+            self.load(LEVELS.index((2, False, 1.0)))
+            if target_latency is not None:
+                # Never above the level we start at: static mode costs more and does not track
+                self.controller = LatencyController(target_latency, self.level, best=self.level)
+
+    def load(self, level):
+        "Switch to a quality level, rebuilding the graph only if the model settings change (returns True then)"
+        model_complexity, static_image_mode, _ = LEVELS[level]
+        previous = LEVELS[self.level] if self.level is not None else None
+        self.level = level
+        if previous is not None and previous[:2] == (model_complexity, static_image_mode):
+            return False
+        if (self.use_holistic):
+            if previous is not None:
+                self.holistic.close()
             self.holistic = self.mp_holistic.Holistic(
-                            model_complexity=2,
+                            static_image_mode=static_image_mode,
+                            model_complexity=model_complexity,
                             enable_segmentation=True,
                             refine_face_landmarks=True)
         else:
-            self.mp_pose = mp.solutions.pose
+            if previous is not None:
+                self.pose.close()
             self.pose = self.mp_pose.Pose(
-                            model_complexity=2,
+                            static_image_mode=static_image_mode,
+                            model_complexity=model_complexity,
                             enable_segmentation=True,
                             min_detection_confidence=0.8)
-
+        return True
 
     def detect(self, frame):
+        height, width, _ = frame.shape
+        scale = LEVELS[self.level][2]
+        if scale != 1.0:
+            small = self.pool.get((int(height * scale), int(width * scale), 3))
+            cv2.resize(frame, (small.shape[1], small.shape[0]), dst=small, interpolation=cv2.INTER_AREA)
+            rgb_image = self.pool.get(small.shape)
+            cv2.cvtColor(small, cv2.COLOR_BGR2RGB, dst=rgb_image)
+            self.pool.put(small)
+        else:
+            rgb_image = self.pool.get(frame.shape)
+            cv2.cvtColor(frame, cv2.COLOR_BGR2RGB, dst=rgb_image)
+        start = time.perf_counter()
+        try:
+            if self.use_holistic:
+                results = self.holistic.process(rgb_image)
+            else:
+                results = self.pose.process(rgb_image)
+        finally:
+            self.pool.put(rgb_image)
+        latency = time.perf_counter() - start
+
+        # Landmarks are normalized, only the mask depends on the inference resolution
+        if scale != 1.0 and results.segmentation_mask is not None:
+            results = results._replace(segmentation_mask=cv2.resize(results.segmentation_mask, (width, height)))
+
+        if self.controller is not None:
+            level = self.controller.update(latency)
+            if level is not None:
+                print(f"[INFO] Inference took {latency * 1000:.0f} ms, switching to quality level {level} {LEVELS[level]}")
+                if self.load(level):
+                    # Initialize the new graph now, so its cold start is not measured on the next frame
+                    scale = LEVELS[level][2]
+                    self.warm_up((int(height * scale), int(width * scale), 3))
+        return results
+
+    def warm_up(self, shape):
+        "Run the graph once on a blank frame so the first real frame does not pay its initialization"
+        blank = np.zeros(shape, np.uint8)
         if self.use_holistic:
-            return self.holistic.process(cv2.cvtColor(frame, cv2.COLOR_BGR2RGB))
+            self.holistic.process(blank)
+            self.holistic.reset()
         else:
-            return self.pose.process(cv2.cvtColor(frame, cv2.COLOR_BGR2RGB))
+            self.pose.process(blank)
+            self.pose.reset()
+
+    def stream(self, frames, ordered=True):
+        "Detect on every frame in the calling thread, yields (frame, results)"
+        for frame in frames:
+            yield frame, self.detect(frame.color_image)
 
-    def draw_landmarks_on_image(self, rgb_image, detection_result):
-        "Draw skeleton on image"
-        annotated_image = np.copy(rgb_image)
+    def draw_landmarks_on_image(self, rgb_image, detection_result, in_place=False):
+        '''
+        Draw skeleton on image
+        in_place=True draws on rgb_image itself (the caller owns it), otherwise the
+        skeleton is drawn on a pool buffer the caller returns with self.pool.put()
+        '''
+        if in_place:
+            annotated_image = rgb_image
+        else:
+            annotated_image = self.pool.get(rgb_image.shape)
+            np.copyto(annotated_image, rgb_image)
         if self.use_holistic:
             self.mp_drawing.draw_landmarks(
                     annotated_image,
@@ -55,13 +232,180 @@ class MediaPipe:
         return annotated_image
     
 
+    def landmarks_to_3D(self, landmarks, indices, image, depth_frame, radius=0):
+        '''
+        (N, 3) RealSense 3D coordinates of landmarks[indices], one vectorized lookup (depth 0 -> z 0)
+        radius > 0 uses the median depth of a patch around every landmark (see Frame.get_distances)
+        '''
+        image_height, image_width, _ = image.shape
+        pixels = np.array([(landmarks[i].x * image_width, landmarks[i].y * image_height) for i in indices])
+        return depth_frame.deproject(pixels, radius)
+
     def point_to_3D(self, landmark, image, depth_frame):
         "Convert Pixel coordinates to RealSense 3D coordinates"
-        depth_intrinsics = depth_frame.profile.as_video_stream_profile().intrinsics
-        image_height, image_width, _ = image.shape
-        x = int(landmark.x * image_width)
-        x = min(image_width-1, max(x, 0))
-        y = int(landmark.y * image_height)
-        y = min(image_height-1, max(y, 0))
-        depth = depth_frame.get_distance(x, y)
-        return rs.rs2_deproject_pixel_to_point(depth_intrinsics, [x, y], depth) if depth > 0 else None
\ No newline at end of file
+        point = self.landmarks_to_3D([landmark], [0], image, depth_frame)[0]
+        return point.tolist() if point[2] > 0 else None
+
+
+###############  Multi-process inference  ###############
+
+def inference_worker(use_holistic, target_latency, frame_names, mask_names, shape, tasks, results, ready):
+    "Worker process: owns one MediaPipe model and serves frames from shared memory"
+    detector = MediaPipe(use_holistic, target_latency=target_latency)
+    detector.warm_up(shape)
+    ready.release()
+    frame_blocks = [shared_memory.SharedMemory(name=name) for name in frame_names]
+    mask_blocks = [shared_memory.SharedMemory(name=name) for name in mask_names]
+    frames = [np.ndarray(shape, np.uint8, buffer=block.buf) for block in frame_blocks]
+    masks = [np.ndarray(shape[:2], np.float32, buffer=block.buf) for block in mask_blocks]
+    try:
+        while True:
+            task = tasks.get()
+            if task is None:
+                break
+            ticket, slot = task
+            output = detector.detect(frames[slot])
+            fields = output._asdict()
+            mask = fields.pop('segmentation_mask', None)
+            if mask is not None:
+                masks[slot][:] = mask
+            # Landmark lists are protobuf messages, they pickle cheaply
+            results.put((ticket, slot, fields, mask is not None))
+    finally:
+        for block in frame_blocks + mask_blocks:
+            block.close()
+
+
+class InferencePool:
+    '''
+    Run MediaPipe in worker processes, each with its own Pose / Holistic model.
+    Frames go through shared memory slots, one per in-flight frame, so at most
+    max_in_flight frames are queued at any time.
+    '''
+    def __init__(self, use_holistic, shape, workers=2, max_in_flight=4, target_latency=None):
+        self.shape = tuple(shape)
+        self.max_in_flight = max_in_flight
+        size = int(np.prod(self.shape))
+        self.frame_blocks = [shared_memory.SharedMemory(create=True, size=size) for _ in range(max_in_flight)]
+        self.mask_blocks = [shared_memory.SharedMemory(create=True, size=size // 3 * 4) for _ in range(max_in_flight)]
+        self.frames = [np.ndarray(self.shape, np.uint8, buffer=block.buf) for block in self.frame_blocks]
+        self.masks = [np.ndarray(self.shape[:2], np.float32, buffer=block.buf) for block in self.mask_blocks]
+        self.free_slots = list(range(max_in_flight))
+        self.done = {}              # ticket -> results not collected yet
+        self.discarded = set()      # tickets nobody will collect (latest-wins)
+        self.next_ticket = 0
+        self.submitted = 0
+        self.completed = 0
+        self.condition = threading.Condition()
+
+        # spawn: workers must not inherit the camera, threads or another model
+        context = multiprocessing.get_context('spawn')
+        self.tasks = context.Queue()
+        self.results = context.Queue()
+        self.ready = context.Semaphore(0)
+        self.workers = [context.Process(target=inference_worker,
+                                        args=(use_holistic, target_latency,
+                                              [block.name for block in self.frame_blocks],
+                                              [block.name for block in self.mask_blocks],
+                                              self.shape, self.tasks, self.results, self.ready),
+                                        daemon=True)
+                        for _ in range(workers)]
+        for worker in self.workers:
+            worker.start()
+        self.collector = threading.Thread(target=self._collect, daemon=True)
+        self.collector.start()
+
+    def _collect(self):
+        while True:
+            result = self.results.get()
+            if result is None:
+                break
+            ticket, slot, fields, has_mask = result
+            # The slot is reused as soon as it is freed, keep our own copy of the mask
+            mask = self.masks[slot].copy() if has_mask else None
+            with self.condition:
+                self.free_slots.append(slot)
+                self.completed += 1
+                if ticket in self.discarded:
+                    self.discarded.remove(ticket)
+                else:
+                    self.done[ticket] = SimpleNamespace(segmentation_mask=mask, **fields)
+                self.condition.notify_all()
+
+    def wait_ready(self, timeout=None):
+        "Wait until every worker has loaded and warmed up its model"
+        return all(self.ready.acquire(timeout=timeout) for _ in self.workers)
+
+    def submit(self, image):
+        "Queue an image for detection and return its ticket, waits while max_in_flight frames are queued"
+        assert image.shape == self.shape, f"InferencePool expects frames of shape {self.shape}"
+        with self.condition:
+            self.condition.wait_for(lambda: self.free_slots)
+            slot = self.free_slots.pop()
+            ticket = self.next_ticket
+            self.next_ticket += 1
+            self.submitted += 1
+        np.copyto(self.frames[slot], image)
+        self.tasks.put((ticket, slot))
+        return ticket
+
+    def result(self, ticket):
+        "Wait for the results of a ticket"
+        with self.condition:
+            self.condition.wait_for(lambda: ticket in self.done)
+            return self.done.pop(ticket)
+
+    def discard(self, ticket):
+        with self.condition:
+            if self.done.pop(ticket, None) is None:
+                self.discarded.add(ticket)
+
+    def stream(self, frames, ordered=True):
+        '''
+        Keep up to max_in_flight frames in flight, yields (frame, results).
+        ordered=True yields every frame in frame order, ordered=False yields
+        only the newest finished frame and drops the older ones (latest wins).
+        '''
+        pending = deque()
+        try:
+            yield from self._stream(frames, ordered, pending)
+        finally:
+            # Frames still in flight when the consumer stops are never collected
+            for _, ticket in pending:
+                self.discard(ticket)
+
+    def _stream(self, frames, ordered, pending):
+        for frame in frames:
+            pending.append((frame, self.submit(frame.color_image)))
+            if ordered:
+                while pending and (len(pending) >= self.max_in_flight or pending[0][1] in self.done):
+                    frame, ticket = pending.popleft()
+                    yield frame, self.result(ticket)
+            else:
+                with self.condition:
+                    if len(pending) >= self.max_in_flight:
+                        self.condition.wait_for(lambda: any(ticket in self.done for _, ticket in pending))
+                    finished = [i for i, (_, ticket) in enumerate(pending) if ticket in self.done]
+                if finished:
+                    for _ in range(finished[-1]):
+                        self.discard(pending.popleft()[1])
+                    frame, ticket = pending.popleft()
+                    yield frame, self.result(ticket)
+
+    def stats(self):
+        with self.condition:
+            return {'workers': len(self.workers),
+                    'submitted': self.submitted,
+                    'completed': self.completed,
+                    'in_flight': self.max_in_flight - len(self.free_slots)}
+
+    def stop(self):
+        for _ in self.workers:
+            self.tasks.put(None)
+        for worker in self.workers:
+            worker.join(timeout=1.0)
+        self.results.put(None)
+        self.collector.join(timeout=1.0)
+        for block in self.frame_blocks + self.mask_blocks:
+            block.close()
+            block.unlink()
@@ -0,0 +1,69 @@
+'''
+Segmentation outline
+
+The outline is traced on a downscaled copy of the segmentation mask, and the
+polygons are scaled back up and simplified before drawing. When the mask
+barely changed since the previous frame (less than `change` of its pixels
+flipped) the previous contours are drawn again without tracing.
+'''
+import cv2
+import numpy as np
+
+
+class Outline:
+    def __init__(self, scale=0.25, threshold=0.1, change=0.005, epsilon=2.0):
+        '''
+        scale       size of the traced mask relative to the segmentation mask
+        threshold   segmentation confidence counted as person
+        change      fraction of mask pixels that must flip before tracing again
+        epsilon     polygon simplification tolerance in full-resolution pixels
+        '''
+        self.scale = scale
+        self.threshold = threshold
+        self.change = change
+        self.epsilon = epsilon
+        self.small = None           # downscaled segmentation mask
+        self.previous = None        # binary mask the contours were traced on
+        self.contours = ()
+        self.traced = 0
+        self.reused = 0
+
+    def update(self, segmentation_mask, depth_mask=None):
+        "Contours of the mask in full-resolution pixels, depth_mask (optional) gates it"
+        height, width = segmentation_mask.shape[:2]
+        size = (max(1, round(width * self.scale)), max(1, round(height * self.scale)))
+        if self.small is None or self.small.shape != size[::-1]:
+            self.small = np.empty(size[::-1], np.float32)
+            self.previous = None
+        cv2.resize(segmentation_mask, size, dst=self.small, interpolation=cv2.INTER_AREA)
+        cv2.threshold(self.small, self.threshold, 1, cv2.THRESH_BINARY, dst=self.small)
+        mask = self.small.astype(np.uint8)
+
+        if depth_mask is not None:
+            depth_mask = cv2.resize(depth_mask, size, interpolation=cv2.INTER_NEAREST)
+            kernel = np.ones((3, 3), np.uint8)
+            mask = cv2.bitwise_and(mask, depth_mask)
+            mask = cv2.morphologyEx(mask, cv2.MORPH_OPEN, kernel)
+            mask = cv2.morphologyEx(mask, cv2.MORPH_CLOSE, kernel)
+
+        # Reuse the last contours while the mask stays (almost) the same
+        if self.previous is not None and \
+                np.count_nonzero(mask != self.previous) <= self.change * mask.size:
+            self.reused += 1
+            return self.contours
+        self.previous = mask
+
+        contours, _ = cv2.findContours(mask, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE)
+        # Back to full resolution (pixel centers), then drop the staircase points
+        factor = np.array([width / size[0], height / size[1]], np.float32)
+        self.contours = tuple(cv2.approxPolyDP(((c + 0.5) * factor).astype(np.int32), self.epsilon, True)
+                              for c in contours)
+        self.traced += 1
+        return self.contours
+
+    def draw(self, image, segmentation_mask, depth_mask=None, color=(255, 255, 255), thickness=2):
+        cv2.drawContours(image, self.update(segmentation_mask, depth_mask), -1, color, thickness)
+        return image
+
+    def stats(self):
+        return {'traced': self.traced, 'reused': self.reused}
@@ -0,0 +1,504 @@
+'''
+RealSense -> Unity calibration
+
+The transform is a similarity (rotation, uniform scale, translation) solved in
+closed form (Umeyama / Kabsch, one SVD) instead of a free 12-parameter affine
+least squares. RealSense camera coordinates are right-handed and Unity's are
+left-handed, so by default the rotation is a reflection (det = -1).
+RANSAC over minimal 3-point samples drops correspondences that do not agree
+with the others (a marker with a bad depth, a joint held in the wrong place).
+
+Calibration keeps its correspondences by key (marker id or joint name), so
+markers seen during normal operation can be fed back with observe() and the
+transform re-solved with refine(), without a new Unity handshake.
+
+CalibrationAccumulator collects correspondences over many frames on its own
+thread and publishes a Calibration once the averaged points fit well enough,
+so the frame loop only hands it samples and keeps streaming.
+
+Solved calibrations are saved to a JSON cache (CALIBRATION_CACHE, default
+calibration_cache.json) keyed by the camera serial and the calibration keys.
+At startup the accumulator checks the cached transform against the anchor
+markers in view and publishes it right away if they still agree, so a restart
+does not wait for a full recalibration.
+
+PointBatch transforms every point sent to Unity in a frame (joints, markers)
+with one matmul and builds the messages from the result.
+Run this file to compare it with transforming the points one by one.
+'''
+import itertools
+import json
+import os
+import threading
+import timeit
+from collections import deque
+
+import numpy as np
+
+
+def similarity_transform(source, target, scale=True, handedness=-1):
+    '''
+    4x4 T minimizing |T source - target| over (N, 3) point sets, N >= 3.
+    handedness  -1 for a right- to left-handed change (RealSense -> Unity), 1 for a proper rotation
+    '''
+    source = np.asarray(source, dtype=np.float64)
+    target = np.asarray(target, dtype=np.float64)
+    source_mean = source.mean(axis=0)
+    target_mean = target.mean(axis=0)
+    source_centered = source - source_mean
+    target_centered = target - target_mean
+
+    U, D, Vt = np.linalg.svd(target_centered.T @ source_centered / len(source))
+    S = np.ones(3)
+    S[2] = handedness * np.sign(np.linalg.det(U) * np.linalg.det(Vt))
+    rotation = U @ np.diag(S) @ Vt
+    variance = (source_centered ** 2).sum() / len(source)
+    factor = (D * S).sum() / variance if scale and variance > 0 else 1.0
+
+    T = np.eye(4)
+    T[:3, :3] = factor * rotation
+    T[:3, 3] = target_mean - T[:3, :3] @ source_mean
+    return T
+
+
+def apply(T, points):
+    "(N, 3) points -> (N, 3) transformed points"
+    points = np.asarray(points, dtype=np.float64).reshape(-1, 3)
+    return points @ T[:3, :3].T + T[:3, 3]
+
+
+def ransac_transform(source, target, threshold=0.1, iterations=100, scale=True, handedness=-1, rng=None):
+    '''
+    similarity_transform fitted on the largest set of correspondences that
+    agree within threshold (Unity units). Returns (T, inlier mask).
+    With few points every 3-point sample is tried instead of random ones.
+    '''
+    source = np.asarray(source, dtype=np.float64)
+    target = np.asarray(target, dtype=np.float64)
+    count = len(source)
+    assert source.shape == target.shape, "Point sets must have the same shape."
+    assert count >= 3, "At least 3 points are required."
+
+    if count <= 7:
+        samples = itertools.combinations(range(count), 3)
+    else:
+        rng = np.random.default_rng() if rng is None else rng
+        samples = (rng.choice(count, 3, replace=False) for _ in range(iterations))
+
+    best = None
+    for sample in samples:
+        sample = list(sample)
+        T = similarity_transform(source[sample], target[sample], scale, handedness)
+        errors = np.linalg.norm(apply(T, source) - target, axis=1)
+        inliers = errors < threshold
+        score = (inliers.sum(), -errors[inliers].sum())
+        if best is None or score > best[0]:
+            best = (score, inliers)
+
+    inliers = best[1]
+    if inliers.sum() < 3:
+        # Nothing agrees, fall back to all points
+        inliers = np.ones(count, dtype=bool)
+    return similarity_transform(source[inliers], target[inliers], scale, handedness), inliers
+
+
+def find_transformation_matrix(realsense_points, unity_points):
+    "4x4 RealSense -> Unity transform, robust to a bad correspondence"
+    T, _ = ransac_transform(realsense_points, unity_points)
+    return T
+
+
+class Calibration:
+    '''
+    Transform solved from keyed correspondences (key -> RealSense point, Unity point).
+    observe() blends in a new RealSense position of a key (an anchor marker seen
+    while streaming), refine() re-solves from the current points and keeps the
+    new transform only if it keeps every inlier and fits them better.
+    '''
+    def __init__(self, keys, realsense_points, unity_points, threshold=0.1, smoothing=0.2,
+                 scale=True, handedness=-1, T=None, inliers=None):
+        self.keys = list(keys)
+        self.realsense = np.array(realsense_points, dtype=np.float64)
+        self.unity = np.array(unity_points, dtype=np.float64)
+        self.threshold = threshold
+        self.smoothing = smoothing
+        self.scale = scale
+        self.handedness = handedness
+        self.accepted = self.realsense.copy()   # points of the current transform
+        self.dirty = False
+        self.refinements = 0
+        if T is None:
+            self.T, self.inliers = ransac_transform(self.realsense, self.unity, threshold, scale=scale, handedness=handedness)
+        else:
+            # Already solved (loaded from the cache)
+            self.T, self.inliers = np.array(T, dtype=np.float64), np.array(inliers, dtype=bool)
+        self.error = self.residual(self.T, self.inliers)
+
+    def residual(self, T, inliers):
+        "RMS distance between transformed RealSense points and their Unity points, over inliers"
+        errors = ((apply(T, self.realsense) - self.unity) ** 2).sum(axis=1)
+        return float(np.sqrt(errors[inliers].mean()))
+
+    def transform(self, points):
+        return apply(self.T, points)
+
+    def check(self, samples, keys=None, min_points=2):
+        '''
+        RMS error of the transform on the keys (default: all) present in samples
+        (key -> RealSense point), None if fewer than min_points of them have depth
+        '''
+        keys = [key for key in (self.keys if keys is None else keys)
+                if key in self.keys and key in samples and samples[key][2] > 0]
+        if len(keys) < min_points:
+            return None
+        index = [self.keys.index(key) for key in keys]
+        errors = ((self.transform([samples[key] for key in keys]) - self.unity[index]) ** 2).sum(axis=1)
+        return float(np.sqrt(errors.mean()))
+
+    def observe(self, key, realsense_point):
+        "New RealSense position of a calibration key, ignored if the key is unknown or has no depth"
+        if key not in self.keys or realsense_point[2] <= 0:
+            return
+        index = self.keys.index(key)
+        self.realsense[index] += self.smoothing * (np.asarray(realsense_point) - self.realsense[index])
+        self.dirty = True
+
+    def refine(self):
+        "Re-solve after observe(), True if the transform changed"
+        if not self.dirty:
+            return False
+        self.dirty = False
+        previous = self.residual(self.T, self.inliers)
+        T, inliers = ransac_transform(self.realsense, self.unity, self.threshold,
+                                      scale=self.scale, handedness=self.handedness)
+        error = self.residual(T, inliers)
+        # A solution that drops correspondences or fits worse is a bad observation, not drift
+        if inliers.sum() < self.inliers.sum() or error > previous:
+            self.realsense[:] = self.accepted
+            return False
+        self.T, self.inliers, self.error = T, inliers, error
+        self.accepted[:] = self.realsense
+        self.refinements += 1
+        return True
+
+    def stats(self):
+        return {'inliers': int(self.inliers.sum()),
+                'points': len(self.keys),
+                'error': round(self.error, 4),
+                'refinements': self.refinements}
+
+    def to_dict(self):
+        return {'keys': self.keys,
+                'realsense': self.accepted.tolist(),
+                'unity': self.unity.tolist(),
+                'T': self.T.tolist(),
+                'inliers': self.inliers.tolist(),
+                'error': self.error,
+                'options': {'threshold': self.threshold, 'smoothing': self.smoothing,
+                            'scale': self.scale, 'handedness': self.handedness}}
+
+    @staticmethod
+    def from_dict(d):
+        return Calibration(d['keys'], d['realsense'], d['unity'], T=d['T'], inliers=d['inliers'], **d['options'])
+
+
+###############  Cache  ###############
+
+CACHE_PATH = os.environ.get('CALIBRATION_CACHE', 'calibration_cache.json')
+
+
+def cache_key(serial, keys):
+    "Cache entry of one camera and one set of calibration keys (in order)"
+    return f"{serial}:" + ",".join(str(key) for key in keys)
+
+
+def read_cache(path=CACHE_PATH):
+    try:
+        with open(path) as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return {}
+    except (OSError, ValueError) as error:
+        print(f"[WARNING] Ignoring calibration cache {path}:", error)
+        return {}
+
+
+def save_calibration(calibration, serial, path=CACHE_PATH):
+    "Store calibration for this camera, other cameras and key sets stay in the cache"
+    if serial is None:
+        return
+    cache = read_cache(path)
+    entry = calibration.to_dict()
+    entry['serial'] = serial
+    cache[cache_key(serial, calibration.keys)] = entry
+    try:
+        # Write and rename, a crash never leaves a truncated cache
+        with open(path + '.tmp', 'w') as f:
+            json.dump(cache, f)
+        os.replace(path + '.tmp', path)
+    except OSError as error:
+        print(f"[WARNING] Could not save calibration to {path}:", error)
+
+
+def load_calibration(serial, keys, path=CACHE_PATH):
+    "Cached Calibration of this camera and keys, None if there is none"
+    if serial is None:
+        return None
+    entry = read_cache(path).get(cache_key(serial, keys))
+    if entry is None:
+        return None
+    try:
+        return Calibration.from_dict(entry)
+    except (KeyError, TypeError, ValueError) as error:
+        print("[WARNING] Ignoring malformed cached calibration:", error)
+        return None
+
+
+def robust_means(samples, min_spread=0.005):
+    '''
+    (K, S, 3) samples per key, NaN where missing -> (K, 3) means and (K,) sample counts
+    after dropping, per key, the samples farther than 3 MADs from the median
+    '''
+    median = np.nanmedian(samples, axis=1)
+    distance = np.linalg.norm(samples - median[:, None, :], axis=2)
+    mad = np.nanmedian(distance, axis=1)
+    keep = distance <= np.maximum(3 * mad, min_spread)[:, None]     # NaN samples compare False
+    counts = keep.sum(axis=1)
+    sums = np.where(keep[..., None], samples, 0.0).sum(axis=1)
+    return sums / np.maximum(counts, 1)[:, None], counts
+
+
+class CalibrationAccumulator:
+    '''
+    Average RealSense positions of the calibration keys over many frames and
+    solve the calibration on a background thread.
+    add() only queues the samples of a frame; once every key has min_samples
+    samples (after outlier removal) and the solved transform has at least
+    min_inliers inliers and an RMS error under max_error, self.calibration is
+    set and self.ready is signalled.
+    With a camera serial, a cached calibration of the same keys is tried first:
+    it is published as soon as the median error of validate_keys (default: all
+    keys, pass the markers when some keys are joints) over validate_frames
+    frames is under max_error, and every new calibration is saved.
+    '''
+    def __init__(self, keys, min_samples=15, max_samples=60, max_error=0.1, min_inliers=4,
+                 serial=None, validate_keys=None, validate_frames=3, max_wait=30, cache_path=CACHE_PATH, **options):
+        self.keys = list(keys)
+        self.serial = serial
+        self.cache_path = cache_path
+        self.validate_keys = validate_keys
+        self.validate_frames = validate_frames
+        self.max_wait = max_wait                            # frames without enough visible anchors
+        self.cached = load_calibration(serial, self.keys, cache_path)
+        self.checks = []                                    # errors of the cached calibration
+        self.waited = 0
+        self.source = None                                  # 'cache' or 'solved' once ready
+        if self.cached is not None:
+            print("[INFO] Found cached calibration:", self.cached.stats())
+        self.min_samples = min_samples
+        self.max_error = max_error
+        self.min_inliers = min_inliers
+        self.options = options                              # Calibration arguments
+        self.samples = {key: deque(maxlen=max_samples) for key in self.keys}
+        self.targets = None                                 # Unity points, in keys order
+        self.pending = deque()
+        self.calibration = None
+        self.ready = threading.Event()
+        self.attempts = 0
+        self.last_error = None
+        self.condition = threading.Condition()
+        self.running = True
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+
+    def set_targets(self, unity_points):
+        "Unity positions of the keys (from the Unity handshake), in keys order"
+        with self.condition:
+            self.targets = np.array(unity_points, dtype=np.float64)
+            self.condition.notify()
+
+    def add(self, samples):
+        "key -> RealSense point seen in one frame, keys without depth are skipped"
+        samples = {key: point for key, point in samples.items() if key in self.samples and point[2] > 0}
+        if samples and not self.ready.is_set():
+            with self.condition:
+                self.pending.append(samples)
+                self.condition.notify()
+
+    def _run(self):
+        while True:
+            with self.condition:
+                self.condition.wait_for(lambda: not self.running or
+                                        (self.pending and (self.targets is not None or self.cached is not None)))
+                if not self.running:
+                    return
+                frames = list(self.pending)
+                self.pending.clear()
+                for samples in frames:
+                    for key, point in samples.items():
+                        self.samples[key].append(point)
+                targets = self.targets
+            if self.cached is not None:
+                self._validate(frames, targets)
+            if not self.ready.is_set() and targets is not None:
+                self._solve(targets)
+            if self.ready.is_set():
+                return
+
+    def _validate(self, frames, targets):
+        "Publish the cached calibration if the anchors in view still agree with it"
+        cached = self.cached
+        if targets is not None and (targets.shape != cached.unity.shape or
+                                    np.abs(targets - cached.unity).max() > cached.threshold):
+            return self._reject("the Unity anchors moved")
+        for samples in frames:
+            error = cached.check(samples, self.validate_keys)
+            if error is None:
+                self.waited += 1
+                if self.waited > self.max_wait:
+                    return self._reject("the anchors are not in view")
+                continue
+            self.checks.append(error)
+            if len(self.checks) >= self.validate_frames:
+                error = float(np.median(self.checks))
+                self.last_error = error
+                if error > self.max_error:
+                    return self._reject(f"error {error:.3f}")
+                self.calibration = cached
+                self.source = 'cache'
+                self.ready.set()
+                return
+
+    def _reject(self, reason):
+        print("[INFO] Cached calibration rejected,", reason)
+        self.cached = None
+
+    def _solve(self, targets):
+        if min(len(samples) for samples in self.samples.values()) < self.min_samples:
+            return
+        size = max(len(samples) for samples in self.samples.values())
+        stacked = np.full((len(self.keys), size, 3), np.nan)
+        for index, key in enumerate(self.keys):
+            stacked[index, :len(self.samples[key])] = self.samples[key]
+        means, counts = robust_means(stacked)
+        if counts.min() < self.min_samples:
+            return
+
+        self.attempts += 1
+        calibration = Calibration(self.keys, means, targets, **self.options)
+        self.last_error = calibration.error
+        if calibration.inliers.sum() >= self.min_inliers and calibration.error <= self.max_error:
+            save_calibration(calibration, self.serial, self.cache_path)
+            self.calibration = calibration
+            self.source = 'solved'
+            self.ready.set()
+
+    def stats(self):
+        return {'samples': {key: len(samples) for key, samples in self.samples.items()},
+                'attempts': self.attempts,
+                'error': None if self.last_error is None else round(self.last_error, 4),
+                'cached': self.cached is not None,
+                'source': self.source,
+                'ready': self.ready.is_set()}
+
+    def stop(self):
+        with self.condition:
+            self.running = False
+            self.condition.notify()
+        self.thread.join(timeout=1.0)
+
+
+###############  Unity payloads  ###############
+
+class PointBatch:
+    '''
+    Fixed set of named points (joint names, marker ids) sent to Unity.
+    The points of a frame are written into a preallocated homogeneous (N, 4)
+    array, transform() applies T to all of them with one matmul, and flat() /
+    vectors() build the message fields from the result with a single tolist().
+    Points not set since the last clear() are left out of the messages.
+    '''
+    def __init__(self, names):
+        self.names = list(names)
+        self.rows = {name: row for row, name in enumerate(self.names)}
+        self.points = np.ones((len(self.names), 4))     # last column stays 1
+        self.result = np.empty((len(self.names), 4))
+        self.present = np.zeros(len(self.names), dtype=bool)
+
+    def clear(self):
+        self.present[:] = False
+
+    def set(self, name, point):
+        row = self.rows[name]
+        self.points[row, :3] = point
+        self.present[row] = True
+
+    def update(self, points):
+        "name -> RealSense point, names outside the batch are ignored"
+        for name, point in points.items():
+            if name in self.rows:
+                self.set(name, point)
+
+    def set_all(self, points, present=True):
+        "(N, 3) points in names order (e.g. filtered ones)"
+        self.points[:, :3] = points
+        self.present[:] = present
+
+    def set_skeleton(self, skeleton, skip=()):
+        "Joints of a MediaPipe.skeleton() message, except the ones in skip"
+        for name in self.names:
+            if name + '_x' in skeleton and name not in skip:
+                self.set(name, (skeleton[name + '_x'], skeleton[name + '_y'], skeleton[name + '_z']))
+
+    def transform(self, T):
+        "(N, 3) Unity points of the batch"
+        np.matmul(self.points, T.T, out=self.result)
+        return self.result[:, :3]
+
+    def flat(self):
+        "{name_x: x, name_y: y, name_z: z} of the transformed points"
+        msg = {}
+        for name, (x, y, z), present in zip(self.names, self.result[:, :3].tolist(), self.present):
+            if present:
+                msg[name + '_x'], msg[name + '_y'], msg[name + '_z'] = x, y, z
+        return msg
+
+    def vectors(self):
+        "name -> {'x', 'y', 'z'} of the transformed points"
+        return {name: {'x': x, 'y': y, 'z': z}
+                for name, (x, y, z), present in zip(self.names, self.result[:, :3].tolist(), self.present)
+                if present}
+
+
+def benchmark(count=20000):
+    "Time a skeleton + marker payload, per point (as the clients did) vs. PointBatch"
+    rng = np.random.default_rng(0)
+    T = similarity_transform(rng.normal(size=(3, 3)), rng.normal(size=(3, 3)))
+    names = ['Head', 'LHand', 'RHand', 'LLeg', 'RLeg', 10, 100, 125, 230]
+    points = {name: rng.normal(size=3).tolist() for name in names}
+
+    def per_point():
+        msg = {}
+        for name, point in points.items():
+            coordinate = list(point)
+            coordinate.append(1)
+            x, y, z = np.matmul(T, np.array(coordinate))[:-1].tolist()
+            msg[name] = {'x': x, 'y': y, 'z': z}
+        return msg
+
+    batch = PointBatch(names)
+
+    def batched():
+        batch.update(points)
+        batch.transform(T)
+        return batch.vectors()
+
+    assert np.allclose([list(v.values()) for v in per_point().values()],
+                       [list(v.values()) for v in batched().values()])
+    for name, function in (('per point', per_point), ('batch', batched)):
+        seconds = min(timeit.repeat(function, number=count, repeat=3)) / count
+        print(f"[INFO] {name:>9}: {seconds * 1e6:.1f} us per payload ({len(names)} points)")
+
+
+if __name__ == '__main__':
+    benchmark()
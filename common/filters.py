@@ -0,0 +1,116 @@
+'''
+Temporal filtering of the points sent to Unity
+
+OneEuroFilter smooths N points at once (joints, markers), each with its own
+last-measurement time, and keeps a filtered velocity so the pose can be
+extrapolated between measurements. The cutoff rises with the speed of a
+point: still points get heavy smoothing (no jitter), fast ones little (no lag).
+Reference: Casiez et al., "1 Euro Filter", CHI 2012.
+
+PosePublisher sends the extrapolated pose on its own thread at a fixed rate,
+so the headset gets updates at its frame rate while inference runs slower.
+'''
+import threading
+import time
+
+import numpy as np
+
+
+def smoothing_factor(cutoff, dt):
+    tau = 1.0 / (2 * np.pi * cutoff)
+    return 1.0 / (1.0 + tau / dt)
+
+
+class OneEuroFilter:
+    def __init__(self, count, min_cutoff=1.0, beta=0.5, d_cutoff=1.0, horizon=0.1, timeout=0.5):
+        '''
+        min_cutoff  cutoff (Hz) of a still point, lower is smoother
+        beta        cutoff increase per m/s of speed, higher lags less
+        horizon     longest extrapolation past the last measurement (s)
+        timeout     a point not measured for this long is no longer fresh (s)
+        '''
+        self.min_cutoff = min_cutoff
+        self.beta = beta
+        self.d_cutoff = d_cutoff
+        self.horizon = horizon
+        self.timeout = timeout
+        self.x = np.zeros((count, 3))           # filtered positions
+        self.dx = np.zeros((count, 3))          # filtered velocities
+        self.t = np.full(count, np.nan)         # time of the last measurement
+        self.lock = threading.Lock()
+
+    def update(self, points, timestamp, valid=None):
+        "(N, 3) measurements at timestamp (s), only the valid ones are used"
+        points = np.asarray(points, dtype=np.float64)
+        valid = np.ones(len(points), dtype=bool) if valid is None else np.asarray(valid, dtype=bool)
+        with self.lock:
+            first = valid & np.isnan(self.t)
+            self.x[first] = points[first]
+            self.dx[first] = 0.0
+
+            rest = valid & ~first
+            if rest.any():
+                dt = np.maximum(timestamp - self.t[rest], 1e-3)[:, None]
+                dx = (points[rest] - self.x[rest]) / dt
+                self.dx[rest] += smoothing_factor(self.d_cutoff, dt) * (dx - self.dx[rest])
+                cutoff = self.min_cutoff + self.beta * np.linalg.norm(self.dx[rest], axis=1, keepdims=True)
+                self.x[rest] += smoothing_factor(cutoff, dt) * (points[rest] - self.x[rest])
+            self.t[valid] = timestamp
+
+    def predict(self, timestamp):
+        '''
+        (N, 3) positions extrapolated to timestamp with the filtered velocities
+        (at most horizon past the last measurement), and the (N,) mask of the
+        points measured within timeout
+        '''
+        with self.lock:
+            age = timestamp - self.t
+            ahead = np.clip(np.nan_to_num(age), 0.0, self.horizon)
+            points = self.x + self.dx * ahead[:, None]
+        return points, age <= self.timeout      # NaN (never measured) compares False
+
+
+class PosePublisher:
+    '''
+    Call build(now) and send the message at a fixed rate on a background thread.
+    build returns the message (None to skip a tick), typically from
+    OneEuroFilter.predict(now).
+    '''
+    def __init__(self, build, send, rate=72.0):
+        self.build = build
+        self.send = send
+        self.period = 1.0 / rate
+        self.published = 0
+        self.failed = 0
+        self.late = 0
+        self.running = True
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+
+    def _run(self):
+        deadline = time.perf_counter()
+        while self.running:
+            deadline += self.period
+            delay = deadline - time.perf_counter()
+            if delay > 0:
+                time.sleep(delay)
+            else:
+                # Behind schedule: skip the missed ticks instead of bursting
+                self.late += 1
+                deadline = time.perf_counter()
+            message = self.build(time.perf_counter())
+            if message is None:
+                continue
+            try:
+                self.send(message)
+                self.published += 1
+            except OSError as error:
+                self.failed += 1
+                print("[WARNING] Failed to publish pose:", type(error).__name__, "-", error)
+
+    def stats(self):
+        return {'published': self.published, 'failed': self.failed, 'late': self.late}
+
+    def stop(self):
+        self.running = False
+        self.thread.join(timeout=1.0)
@@ -0,0 +1,529 @@
+'''
+Frame sources
+
+Every client reads frames through a FrameSource so the capture device can be
+swapped without touching the frame loop:
+    RealSenseSource - live RealSense color + depth (aligned, sparse-aligned or raw)
+    WebcamSource    - live webcam color only
+    ReplaySource    - memory-mapped replay of a recorded session
+    Recorder        - wraps any source and records what it serves
+    ThreadedSource  - wraps any source and captures on a background thread
+
+Derived depth products (depth_mask, depth_colormap, the aligned depth of a
+SparseFrame) are computed the first time they are read and then kept on the
+frame, so a product nobody reads costs nothing and one read by several
+consumers is computed once.
+
+Recording format (*.rsrec):
+    [0, HEADER_SIZE)   b'RSREC1\\n' + JSON metadata, padded with spaces
+    [HEADER_SIZE, ...) fixed-size records (timestamp, color[, depth])
+'''
+import functools
+import json
+import os
+import threading
+import time
+from types import SimpleNamespace
+
+import cv2
+import numpy as np
+
+from geometry import Intrinsics, Extrinsics, SparseAligner, ray_table, patch_pixels, patch_depth
+
+try:
+    import pyrealsense2 as rs
+except ImportError:
+    rs = None
+
+MAGIC = b'RSREC1\n'
+HEADER_SIZE = 4096
+
+
+def memoized(function):
+    "Frame property computed on first access and kept for the lifetime of the frame"
+    name = function.__name__
+
+    @functools.wraps(function)
+    def product(self):
+        return self.memo(name, function, self)
+    return property(product)
+
+
+class Frame:
+    "One color (+ depth) frame, as served by a FrameSource"
+    mask_range = (0.1, 3.0)     # meters counted as foreground by depth_mask
+
+    def __init__(self, color_image, depth_image=None, timestamp=0.0, intrinsics=None, depth_scale=0.001):
+        self.color_image = color_image
+        self.depth_image = depth_image
+        self.timestamp = timestamp
+        self.intrinsics = intrinsics
+        self.depth_scale = depth_scale
+
+    def memo(self, key, function, *args):
+        "function(*args), computed once per frame and key (frames can be shared between threads)"
+        products = self.__dict__.setdefault('_products', {})
+        if key not in products:
+            # Reentrant: a product may read another one (depth_mask reads a SparseFrame's depth_image)
+            with self.__dict__.setdefault('_products_lock', threading.RLock()):
+                if key not in products:
+                    products[key] = function(*args)
+        return products[key]
+
+    @memoized
+    def depth_mask(self):
+        "uint8 0/1 mask of the pixels with a depth inside mask_range"
+        near, far = (np.asarray(self.mask_range) / self.depth_scale).astype(np.uint16)
+        return cv2.inRange(self.depth_image, int(near), int(far)) // 255
+
+    @memoized
+    def depth_colormap(self):
+        "Depth for display (image must be converted to 8-bit per pixel first)"
+        return cv2.applyColorMap(cv2.convertScaleAbs(self.depth_image, alpha=0.03), cv2.COLORMAP_JET)
+
+    def get_distance(self, x, y):
+        "Depth in meters at pixel (x, y), same as rs.depth_frame.get_distance"
+        return float(self.depth_image[y, x]) * self.depth_scale
+
+    def get_distances(self, pixels, radius=0):
+        '''
+        Depths in meters of a batch of (x, y) pixels, 0 where there is no depth.
+        radius > 0 takes the median of the valid depths in a (2 radius + 1)^2
+        patch around every pixel, so a single-pixel hole does not lose the point.
+        '''
+        if radius > 0:
+            return patch_depth(self.get_distances(patch_pixels(pixels, radius)), len(pixels))
+        x, y = ray_table(self.intrinsics).pixels(pixels)
+        return self.depth_image[y, x] * self.depth_scale
+
+    def deproject(self, pixels, radius=0):
+        "(N, 2) pixels -> (N, 3) camera points in meters, (0, 0, 0) where there is no depth"
+        return ray_table(self.intrinsics).deproject(pixels, self.get_distances(pixels, radius))
+
+
+class FrameSource:
+    "Base class of every frame source"
+    has_depth = False
+    exhausted = False
+    serial = None       # camera serial number, None when unknown (webcam)
+
+    def read(self):
+        "Return the next Frame, or None if no frame is available"
+        raise NotImplementedError
+
+    def stop(self):
+        pass
+
+    def __iter__(self):
+        while True:
+            frame = self.read()
+            if frame is None:
+                if self.exhausted:
+                    return
+                continue
+            yield frame
+
+
+class SparseFrame(Frame):
+    '''
+    RealSense frame whose depth is not aligned to color up front.
+    get_distance() maps just the requested color pixels into the raw depth
+    image; depth_image runs the full rs.align only if someone reads it.
+    '''
+    def __init__(self, color_image, raw_depth_image, timestamp, source, frames):
+        self.color_image = color_image
+        self.raw_depth_image = raw_depth_image
+        self.timestamp = timestamp
+        self.intrinsics = source.intrinsics
+        self.depth_scale = source.depth_scale
+        self.source = source
+        self.frames = frames
+
+    @memoized
+    def depth_image(self):
+        return self.source.align_depth(self.frames)
+
+    def get_distance(self, x, y):
+        return float(self.source.aligner.depths(self.raw_depth_image, [(x, y)])[0])
+
+    def get_distances(self, pixels, radius=0):
+        "Depths in meters of a batch of (x, y) color pixels, see Frame.get_distances"
+        if radius > 0:
+            return patch_depth(self.get_distances(patch_pixels(pixels, radius)), len(pixels))
+        return self.source.aligner.depths(self.raw_depth_image, np.column_stack(ray_table(self.intrinsics).pixels(pixels)))
+
+
+###############  Live sources  ###############
+
+class RealSenseSource(FrameSource):
+    '''
+    align=True      depth aligned to color with rs.align on every frame
+    align='sparse'  raw depth, color pixels are mapped into it on demand (SparseFrame)
+    align=False     raw depth, depth and color pixels are not related
+    '''
+    has_depth = True
+
+    def __init__(self, width, height, fps, align=True):
+        self.pipeline = rs.pipeline()
+        config = rs.config()
+        pipeline_wrapper = rs.pipeline_wrapper(self.pipeline)
+        pipeline_profile = config.resolve(pipeline_wrapper)
+        device = pipeline_profile.get_device()
+        found_rgb = False
+        for s in device.sensors:
+            if s.get_info(rs.camera_info.name) == 'RGB Camera':
+                found_rgb = True
+                break
+        if not found_rgb:
+            print("[main] The demo requires Depth camera with Color sensor")
+            exit(0)
+        config.enable_stream(rs.stream.depth, width, height, rs.format.z16, fps)
+        config.enable_stream(rs.stream.color, width, height, rs.format.bgr8, fps)
+        profile = self.pipeline.start(config)
+        self.serial = device.get_info(rs.camera_info.serial_number)
+        self.depth_scale = profile.get_device().first_depth_sensor().get_depth_scale()
+        self.sparse = align == 'sparse'
+        self.align = rs.align(rs.stream.color) if align else None
+        self.intrinsics = None
+        if self.sparse:
+            depth_profile = profile.get_stream(rs.stream.depth).as_video_stream_profile()
+            color_profile = profile.get_stream(rs.stream.color).as_video_stream_profile()
+            self.intrinsics = color_profile.get_intrinsics()
+            self.aligner = SparseAligner(Intrinsics.from_rs(depth_profile.get_intrinsics()),
+                                         Intrinsics.from_rs(self.intrinsics),
+                                         Extrinsics.from_rs(depth_profile.get_extrinsics_to(color_profile)),
+                                         Extrinsics.from_rs(color_profile.get_extrinsics_to(depth_profile)),
+                                         self.depth_scale)
+            self.align_lock = threading.Lock()
+
+    def read(self):
+        frames = self.pipeline.wait_for_frames()
+        if self.sparse:
+            color_frame = frames.get_color_frame()
+            depth_frame = frames.get_depth_frame()
+            if not color_frame or not depth_frame:
+                return None
+            return SparseFrame(np.asanyarray(color_frame.get_data()),
+                               np.asanyarray(depth_frame.get_data()),
+                               color_frame.get_timestamp() / 1000.0,
+                               self,
+                               frames)
+        if self.align is not None:
+            frames = self.align.process(frames)
+        color_frame = frames.get_color_frame()
+        depth_frame = frames.get_depth_frame()
+        if not color_frame or not depth_frame:
+            return None
+        if self.intrinsics is None:
+            self.intrinsics = depth_frame.profile.as_video_stream_profile().intrinsics
+        return Frame(np.asanyarray(color_frame.get_data()),
+                     np.asanyarray(depth_frame.get_data()),
+                     color_frame.get_timestamp() / 1000.0,
+                     self.intrinsics,
+                     self.depth_scale)
+
+    def align_depth(self, frames):
+        "Full-frame depth aligned to color, for SparseFrame consumers that need it"
+        with self.align_lock:
+            aligned_frames = self.align.process(frames)
+        return np.asanyarray(aligned_frames.get_depth_frame().get_data())
+
+    def stop(self):
+        self.pipeline.stop()
+
+
+class WebcamSource(FrameSource):
+    def __init__(self, width, height, fps, index=0):
+        self.cap = cv2.VideoCapture(index)
+        self.cap.set(cv2.CAP_PROP_FRAME_WIDTH, width)
+        self.cap.set(cv2.CAP_PROP_FRAME_HEIGHT, height)
+        self.cap.set(cv2.CAP_PROP_FPS, fps)
+
+    def read(self):
+        ret, color_image = self.cap.read()
+        if not ret:
+            return None
+        return Frame(color_image, timestamp=time.time())
+
+    def stop(self):
+        self.cap.release()
+
+
+###############  Recording  ###############
+
+def record_dtype(width, height, has_depth):
+    "Packed numpy dtype of one recorded frame"
+    fields = [('timestamp', '<f8'), ('color', 'u1', (height, width, 3))]
+    if has_depth:
+        fields.append(('depth', '<u2', (height, width)))
+    return np.dtype(fields)
+
+
+def intrinsics_to_dict(intrinsics):
+    if intrinsics is None:
+        return None
+    return {'width': intrinsics.width, 'height': intrinsics.height,
+            'ppx': intrinsics.ppx, 'ppy': intrinsics.ppy,
+            'fx': intrinsics.fx, 'fy': intrinsics.fy,
+            'model': int(intrinsics.model), 'coeffs': list(intrinsics.coeffs)}
+
+
+def intrinsics_from_dict(d):
+    "geometry.Intrinsics (works without pyrealsense2, so recordings replay anywhere)"
+    if d is None:
+        return None
+    return Intrinsics(d['width'], d['height'], d['ppx'], d['ppy'], d['fx'], d['fy'], d['model'], d['coeffs'])
+
+
+class Recorder(FrameSource):
+    "Serve frames from another source and append them to a recording"
+    def __init__(self, source, path):
+        self.source = source
+        self.path = path
+        self.has_depth = source.has_depth
+        self.serial = source.serial
+        self.file = None
+
+    def _open(self, frame):
+        height, width, _ = frame.color_image.shape
+        metadata = {
+            'width': width,
+            'height': height,
+            'has_depth': self.has_depth,
+            'depth_scale': frame.depth_scale,
+            'intrinsics': intrinsics_to_dict(frame.intrinsics),
+            'serial': self.serial,
+        }
+        header = MAGIC + json.dumps(metadata).encode('utf-8')
+        assert len(header) < HEADER_SIZE, "Recording metadata is too large."
+        self.file = open(self.path, 'wb')
+        self.file.write(header.ljust(HEADER_SIZE, b' '))
+        print(f"[INFO] Recording to {self.path}")
+
+    def read(self):
+        frame = self.source.read()
+        if frame is None:
+            return None
+        if self.file is None:
+            self._open(frame)
+        self.file.write(np.float64(frame.timestamp).tobytes())
+        self.file.write(np.ascontiguousarray(frame.color_image).data)
+        if self.has_depth:
+            self.file.write(np.ascontiguousarray(frame.depth_image).data)
+        return frame
+
+    @property
+    def exhausted(self):
+        return self.source.exhausted
+
+    def stop(self):
+        if self.file is not None:
+            self.file.close()
+        self.source.stop()
+
+
+###############  Replay  ###############
+
+class ReplaySource(FrameSource):
+    "Replay a recording through a memory map (frames are views, not copies)"
+    def __init__(self, path, realtime=True, loop=False):
+        with open(path, 'rb') as f:
+            header = f.read(HEADER_SIZE)
+        if not header.startswith(MAGIC):
+            raise ValueError(f"{path} is not a recording")
+        metadata = json.loads(header[len(MAGIC):].decode('utf-8'))
+        self.has_depth = metadata['has_depth']
+        self.depth_scale = metadata['depth_scale']
+        self.intrinsics = intrinsics_from_dict(metadata['intrinsics'])
+        self.serial = metadata.get('serial')
+        dtype = record_dtype(metadata['width'], metadata['height'], self.has_depth)
+        count = (os.path.getsize(path) - HEADER_SIZE) // dtype.itemsize
+        if count == 0:
+            raise ValueError(f"{path} contains no frames")
+        # Copy-on-write: callers may draw on the frames without touching the file
+        self.records = np.memmap(path, dtype=dtype, mode='c', offset=HEADER_SIZE, shape=(count,))
+        self.timestamps = self.records['timestamp']
+        self.colors = self.records['color']
+        self.depths = self.records['depth'] if self.has_depth else None
+        self.realtime = realtime
+        self.loop = loop
+        self.index = 0
+        self.start = None
+
+    def __len__(self):
+        return len(self.records)
+
+    @property
+    def exhausted(self):
+        return self.index >= len(self.records) and not self.loop
+
+    def read(self):
+        if self.index >= len(self.records):
+            if not self.loop:
+                return None
+            self.index = 0
+            self.start = None
+        index = self.index
+        self.index += 1
+        timestamp = float(self.timestamps[index])
+
+        # Native speed: sleep until the frame is due
+        if self.realtime:
+            now = time.perf_counter()
+            if self.start is None:
+                self.start = (now, timestamp)
+            due = self.start[0] + (timestamp - self.start[1])
+            if due > now:
+                time.sleep(due - now)
+
+        return Frame(self.colors[index],
+                     self.depths[index] if self.has_depth else None,
+                     timestamp,
+                     self.intrinsics,
+                     self.depth_scale)
+
+    def stop(self):
+        self.records = self.timestamps = self.colors = self.depths = None
+
+
+###############  Threaded capture  ###############
+
+class ThreadedSource(FrameSource):
+    '''
+    Capture on a producer thread into a small ring buffer.
+    The producer never waits for consumers: when they are slow, the oldest
+    frames are overwritten and read() always returns the newest frame, so
+    latency stays bounded instead of frames queueing up in librealsense.
+    lossless=True makes the producer wait instead, and read() returns the
+    oldest frame nobody has read yet (each frame is served once), so a fast
+    replay is processed frame for frame. None turns it on for a ReplaySource
+    that is neither realtime nor looping.
+    '''
+    def __init__(self, source, size=3, lossless=None):
+        if lossless is None:
+            lossless = isinstance(source, ReplaySource) and not source.realtime and not source.loop
+        self.source = source
+        self.lossless = lossless
+        self.has_depth = source.has_depth
+        self.serial = source.serial
+        self.ring = [None] * size
+        self.count = 0              # frames captured (= next frame index)
+        self.served = 0             # frames returned by read()
+        self.dropped = 0            # frames overwritten or skipped before any read()
+        self.last_served = -1
+        self.age = 0.0              # capture-to-read delay of the last served frame
+        self.local = threading.local()
+        self.condition = threading.Condition()
+        self.running = True
+        self.thread = threading.Thread(target=self._capture, daemon=True)
+        self.thread.start()
+
+    def _capture(self):
+        while self.running and not self.source.exhausted:
+            frame = self.source.read()
+            if frame is None:
+                continue
+            frame.captured_at = time.perf_counter()
+            with self.condition:
+                if self.lossless:
+                    # Do not overwrite a frame that has not been served yet
+                    self.condition.wait_for(lambda: self.count - len(self.ring) <= self.last_served or not self.running)
+                    if not self.running:
+                        break
+                frame.index = self.count
+                self.ring[self.count % len(self.ring)] = frame
+                self.count += 1
+                self.condition.notify_all()
+        with self.condition:
+            self.running = False
+            self.condition.notify_all()
+
+    @property
+    def exhausted(self):
+        last = self.last_served if self.lossless else getattr(self.local, 'last', -1)
+        return not self.running and last >= self.count - 1
+
+    def read(self, timeout=1.0):
+        "Wait for a frame newer than the one this thread read last, and return the newest"
+        if self.lossless:
+            return self._read_next(timeout)
+        last = getattr(self.local, 'last', -1)
+        with self.condition:
+            if not self.condition.wait_for(lambda: self.count - 1 > last or not self.running, timeout):
+                return None
+            if self.count - 1 <= last:
+                return None
+            frame = self.ring[(self.count - 1) % len(self.ring)]
+            if frame.index > self.last_served:
+                self.dropped += frame.index - self.last_served - 1
+                self.last_served = frame.index
+            self.served += 1
+            self.age = time.perf_counter() - frame.captured_at
+        self.local.last = frame.index
+        return frame
+
+    def _read_next(self, timeout):
+        "Lossless read(): the oldest frame not served yet"
+        with self.condition:
+            if not self.condition.wait_for(lambda: self.count - 1 > self.last_served or not self.running, timeout):
+                return None
+            if self.count - 1 <= self.last_served:
+                return None
+            self.last_served += 1
+            frame = self.ring[self.last_served % len(self.ring)]
+            self.served += 1
+            self.age = time.perf_counter() - frame.captured_at
+            self.condition.notify_all()
+        return frame
+
+    def stats(self):
+        with self.condition:
+            return {'captured': self.count,
+                    'served': self.served,
+                    'dropped': self.dropped,
+                    'age_ms': round(self.age * 1000, 2)}
+
+    def stop(self):
+        with self.condition:
+            self.running = False
+            self.condition.notify_all()
+        self.thread.join(timeout=1.0)
+        self.source.stop()
+
+
+def open_source(width, height, fps, align=True, use_realsense=True):
+    '''
+    Open the frame source selected by the environment:
+        RSREPLAY=<path>     replay a recording instead of opening a camera
+        RSREPLAY_FAST=1     replay as fast as possible instead of at native speed
+        RSRECORD=<path>     record the served frames to <path>
+    '''
+    replay_path = os.environ.get('RSREPLAY')
+    record_path = os.environ.get('RSRECORD')
+    if replay_path:
+        print(f"[INFO] Replaying {replay_path}")
+        source = ReplaySource(replay_path, realtime=os.environ.get('RSREPLAY_FAST') != '1')
+    elif use_realsense:
+        source = RealSenseSource(width, height, fps, align)
+    else:
+        source = WebcamSource(width, height, fps)
+    if record_path:
+        source = Recorder(source, record_path)
+    return source
+
+
+def check_sparse_products():
+    "Derived products of a SparseFrame read its memoized depth_image from inside the memo, this must not deadlock"
+    depth = np.full((4, 6), 1000, np.uint16)
+    source = SimpleNamespace(intrinsics=None, depth_scale=0.001, align_depth=lambda frames: depth)
+    frame = SparseFrame(np.zeros((4, 6, 3), np.uint8), depth, 0.0, source, None)
+    reader = threading.Thread(target=lambda: (frame.depth_mask, frame.depth_colormap), daemon=True)
+    reader.start()
+    reader.join(timeout=5.0)
+    assert not reader.is_alive(), "SparseFrame.depth_mask deadlocked"
+    assert frame.depth_mask.all() and frame.depth_colormap.shape == (4, 6, 3)
+    print("[INFO] SparseFrame depth products OK")
+
+
+if __name__ == '__main__':
+    check_sparse_products()
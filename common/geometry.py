@@ -0,0 +1,234 @@
+'''
+Camera geometry in NumPy
+
+Vectorized versions of the librealsense helpers (rsutil.h) so batches of
+pixels can be projected / deprojected without one Python call per point.
+For pixels of a whole image, RayTable precomputes the (undistorted) ray of
+every pixel once per stream, so deprojection is a gather and a multiply.
+Reference:
+https://github.com/IntelRealSense/librealsense/blob/master/include/librealsense2/rsutil.h
+'''
+import numpy as np
+
+# rs.distortion values
+NONE, MODIFIED_BROWN_CONRADY, INVERSE_BROWN_CONRADY, FTHETA, BROWN_CONRADY, KANNALA_BRANDT4 = range(6)
+
+
+class Intrinsics:
+    "Pinhole intrinsics with librealsense distortion coefficients"
+    def __init__(self, width, height, ppx, ppy, fx, fy, model=NONE, coeffs=(0.0, 0.0, 0.0, 0.0, 0.0)):
+        self.width, self.height = width, height
+        self.ppx, self.ppy = ppx, ppy
+        self.fx, self.fy = fx, fy
+        self.model = int(model)
+        self.coeffs = np.asarray(coeffs, dtype=np.float64)
+
+    @staticmethod
+    def from_rs(intrinsics):
+        return Intrinsics(intrinsics.width, intrinsics.height, intrinsics.ppx, intrinsics.ppy,
+                          intrinsics.fx, intrinsics.fy, int(intrinsics.model), list(intrinsics.coeffs))
+
+    def key(self):
+        return (self.width, self.height, self.ppx, self.ppy, self.fx, self.fy, self.model, tuple(self.coeffs))
+
+
+def intrinsics_key(intrinsics):
+    "Hashable identity of an Intrinsics or rs.intrinsics"
+    if isinstance(intrinsics, Intrinsics):
+        return intrinsics.key()
+    return (intrinsics.width, intrinsics.height, intrinsics.ppx, intrinsics.ppy,
+            intrinsics.fx, intrinsics.fy, int(intrinsics.model), tuple(intrinsics.coeffs))
+
+
+class Extrinsics:
+    "Rigid transform between two camera streams"
+    def __init__(self, rotation, translation):
+        self.rotation = np.asarray(rotation, dtype=np.float64).reshape(3, 3)
+        self.translation = np.asarray(translation, dtype=np.float64)
+
+    @staticmethod
+    def from_rs(extrinsics):
+        # librealsense stores the rotation column-major
+        return Extrinsics(np.asarray(extrinsics.rotation).reshape(3, 3).T, extrinsics.translation)
+
+    def transform(self, points):
+        return points @ self.rotation.T + self.translation
+
+
+def project(intrinsics, points):
+    "(N, 3) points -> (N, 2) pixels, like rs2_project_point_to_pixel"
+    points = np.asarray(points, dtype=np.float64)
+    x = points[..., 0] / points[..., 2]
+    y = points[..., 1] / points[..., 2]
+    if intrinsics.model in (MODIFIED_BROWN_CONRADY, INVERSE_BROWN_CONRADY, BROWN_CONRADY):
+        k1, k2, p1, p2, k3 = intrinsics.coeffs[:5]
+        r2 = x * x + y * y
+        f = 1 + k1 * r2 + k2 * r2 * r2 + k3 * r2 * r2 * r2
+        x, y = x * f, y * f
+        x, y = (x + 2 * p1 * x * y + p2 * (r2 + 2 * x * x),
+                y + 2 * p2 * x * y + p1 * (r2 + 2 * y * y))
+    return np.stack([x * intrinsics.fx + intrinsics.ppx, y * intrinsics.fy + intrinsics.ppy], axis=-1)
+
+
+def undistort(intrinsics, x, y):
+    "Normalized distorted coordinates -> normalized ray coordinates"
+    if intrinsics.model in (INVERSE_BROWN_CONRADY, BROWN_CONRADY):
+        k1, k2, p1, p2, k3 = intrinsics.coeffs[:5]
+        xo, yo = x, y
+        # Same fixed-point iteration as librealsense
+        for _ in range(10):
+            r2 = x * x + y * y
+            icdist = 1 / (1 + ((k3 * r2 + k2) * r2 + k1) * r2)
+            xq, yq = x / icdist, y / icdist
+            delta_x = 2 * p1 * xq * yq + p2 * (r2 + 2 * xq * xq)
+            delta_y = 2 * p2 * xq * yq + p1 * (r2 + 2 * yq * yq)
+            x = (xo - delta_x) * icdist
+            y = (yo - delta_y) * icdist
+    return x, y
+
+
+def deproject(intrinsics, pixels, depths):
+    "(N, 2) pixels + (N,) depths in meters -> (N, 3) points, like rs2_deproject_pixel_to_point"
+    pixels = np.asarray(pixels, dtype=np.float64)
+    depths = np.asarray(depths, dtype=np.float64)
+    x = (pixels[..., 0] - intrinsics.ppx) / intrinsics.fx
+    y = (pixels[..., 1] - intrinsics.ppy) / intrinsics.fy
+    x, y = undistort(intrinsics, x, y)
+    return np.stack([depths * x, depths * y, depths], axis=-1)
+
+
+class SparseAligner:
+    '''
+    Find the depth of individual color pixels in the raw (unaligned) depth image.
+    Same search as rs2_project_color_pixel_to_depth_pixel: walk the segment the
+    color pixel can map to between depth_min and depth_max, and keep the depth
+    pixel that reprojects closest to the color pixel. All pixels of a batch are
+    searched at once.
+    '''
+    def __init__(self, depth_intrinsics, color_intrinsics, depth_to_color, color_to_depth,
+                 depth_scale, depth_min=0.1, depth_max=10.0):
+        self.depth_intrinsics = depth_intrinsics
+        self.color_intrinsics = color_intrinsics
+        self.depth_to_color = depth_to_color
+        self.color_to_depth = color_to_depth
+        self.depth_scale = depth_scale
+        self.depth_min = depth_min
+        self.depth_max = depth_max
+
+    def segment(self, pixels, depth):
+        "Depth pixels of the color pixels if they were at the given depth"
+        points = deproject(self.color_intrinsics, pixels, np.full(len(pixels), depth))
+        return project(self.depth_intrinsics, self.color_to_depth.transform(points))
+
+    def depths(self, depth_image, pixels):
+        "(N, 2) color pixels -> (N,) depths in meters, 0 where no valid depth was found"
+        pixels = np.asarray(pixels, dtype=np.float64).reshape(-1, 2)
+        if len(pixels) == 0:
+            return np.zeros(0)
+        height, width = depth_image.shape
+        start = self.segment(pixels, self.depth_min)
+        end = self.segment(pixels, self.depth_max)
+        limit = np.array([width - 1, height - 1])
+        start = np.clip(start, 0, limit)
+        end = np.clip(end, 0, limit)
+
+        # One candidate per depth pixel along the longest segment
+        steps = int(np.ceil(np.abs(end - start).max())) + 1
+        t = np.linspace(0.0, 1.0, steps)
+        candidates = start[:, None, :] + (end - start)[:, None, :] * t[None, :, None]   # (N, steps, 2)
+        candidates = np.rint(candidates).astype(np.intp)
+        depth = depth_image[candidates[..., 1], candidates[..., 0]] * self.depth_scale
+
+        # Reproject every candidate into the color image
+        points = deproject(self.depth_intrinsics, candidates, depth)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            projected = project(self.color_intrinsics, self.depth_to_color.transform(points))
+            distance = ((projected - pixels[:, None, :]) ** 2).sum(axis=-1)
+        distance[depth == 0] = np.inf
+
+        best = distance.argmin(axis=1)
+        result = depth[np.arange(len(pixels)), best]
+        result[np.isinf(distance[np.arange(len(pixels)), best])] = 0.0
+        return result
+
+
+###############  Ray tables  ###############
+
+class RayTable:
+    "Ray (x, y, 1) of every pixel of a stream, deproject() is then depth * ray"
+    def __init__(self, intrinsics):
+        self.intrinsics = intrinsics
+        self.width, self.height = intrinsics.width, intrinsics.height
+        u, v = np.meshgrid(np.arange(self.width, dtype=np.float64), np.arange(self.height, dtype=np.float64))
+        x, y = undistort(intrinsics, (u - intrinsics.ppx) / intrinsics.fx, (v - intrinsics.ppy) / intrinsics.fy)
+        self.rays = np.stack([x, y, np.ones_like(x)], axis=-1).astype(np.float32)     # (height, width, 3)
+
+    def pixels(self, pixels):
+        "(N, 2) pixels -> integer (x, y) indices inside the image"
+        pixels = np.asarray(pixels).reshape(-1, 2)
+        if pixels.dtype.kind == 'f':
+            pixels = pixels.astype(np.intp)
+        x = np.clip(pixels[:, 0], 0, self.width - 1)
+        y = np.clip(pixels[:, 1], 0, self.height - 1)
+        return x, y
+
+    def deproject(self, pixels, depths):
+        "(N, 2) pixels + (N,) depths in meters -> (N, 3) points, (0, 0, 0) where the depth is 0"
+        x, y = self.pixels(pixels)
+        return self.rays[y, x] * np.asarray(depths, dtype=np.float32)[:, None]
+
+    def deproject_image(self, depth_image, pixels, depth_scale):
+        "Deproject pixels with their depth looked up in a depth image aligned to this stream"
+        x, y = self.pixels(pixels)
+        depths = depth_image[y, x] * np.float32(depth_scale)
+        return self.rays[y, x] * depths[:, None]
+
+
+ray_tables = {}     # intrinsics_key -> RayTable
+
+
+def ray_table(intrinsics):
+    "RayTable of a stream (Intrinsics or rs.intrinsics), built once per intrinsics"
+    key = intrinsics_key(intrinsics)
+    table = ray_tables.get(key)
+    if table is None:
+        if not isinstance(intrinsics, Intrinsics):
+            intrinsics = Intrinsics.from_rs(intrinsics)
+        table = ray_tables[key] = RayTable(intrinsics)
+    return table
+
+
+def patch_pixels(pixels, radius):
+    "(N, 2) pixels -> (N * K, 2) pixels of the (2 radius + 1)^2 patches around them"
+    pixels = np.rint(np.asarray(pixels, dtype=np.float64).reshape(-1, 2)).astype(np.intp)
+    steps = np.arange(-radius, radius + 1)
+    offsets = np.stack(np.meshgrid(steps, steps), axis=-1).reshape(-1, 2)
+    return (pixels[:, None, :] + offsets[None, :, :]).reshape(-1, 2)
+
+
+def patch_depth(depths, count, min_valid=0.25):
+    '''
+    (N * K,) depths of N patches -> (N,) median depth of every patch, ignoring
+    holes (0). A patch with less than min_valid of its pixels valid gets 0.
+    '''
+    depths = np.asarray(depths, dtype=np.float64).reshape(count, -1)
+    valid = depths > 0
+    enough = valid.sum(axis=1) >= max(1, min_valid * depths.shape[1])
+    result = np.zeros(count)
+    if enough.any():
+        result[enough] = np.nanmedian(np.where(valid, depths, np.nan)[enough], axis=1)
+    return result
+
+
+def polygon_centroids(polygons):
+    "(N, K, 2) polygons (e.g. ArUco corners) -> (N, 2) integer centroids, shoelace formula"
+    if len(polygons) == 0:
+        return np.zeros((0, 2), np.intp)
+    polygons = np.asarray(polygons, dtype=np.float64).reshape(len(polygons), -1, 2)
+    x0, y0 = polygons[..., 0], polygons[..., 1]
+    x1, y1 = np.roll(x0, -1, axis=1), np.roll(y0, -1, axis=1)
+    area = x0 * y1 - x1 * y0
+    signed_area = area.sum(axis=1) * 0.5
+    x = ((x0 + x1) * area).sum(axis=1) / (6 * signed_area)
+    y = ((y0 + y1) * area).sum(axis=1) / (6 * signed_area)
+    return np.stack([x, y], axis=1).astype(np.intp)
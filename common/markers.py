@@ -0,0 +1,89 @@
+'''
+ArUco marker tracking
+
+Markers move slowly, so after a full-frame scan each marker is searched again
+only in a small window around its last corners. A full scan still runs every
+`rescan_every` frames (to pick up new markers) and on the frame after a
+marker is lost.
+'''
+import time
+
+import cv2
+import numpy as np
+
+
+class MarkerTracker:
+    def __init__(self, detector, rescan_every=30, margin=0.75, scale=1.0):
+        '''
+        detector      cv2.aruco.ArucoDetector
+        margin        window padding around a marker, as a fraction of the marker size
+        scale         < 1 downscales the windows before detection
+        '''
+        self.detector = detector
+        self.rescan_every = rescan_every
+        self.margin = margin
+        self.scale = scale
+        self.markers = {}           # id -> (4, 2) corners in the last frame
+        self.frame = 0
+        self.rescan = True
+        self.full_scans = 0
+        self.window_scans = 0
+        self.pixels = 0             # pixels searched in the last frame
+        self.cost = 0.0             # seconds spent in the last detect()
+
+    def detect(self, image):
+        "Same results as detector.detectMarkers(image): (corners, ids)"
+        start = time.perf_counter()
+        if self.rescan or not self.markers or self.frame % self.rescan_every == 0:
+            corners, ids, _ = self.detector.detectMarkers(image)
+            found = {} if ids is None else {int(i): c[0] for c, i in zip(corners, ids.ravel())}
+            self.rescan = False
+            self.full_scans += 1
+            self.pixels = image.shape[0] * image.shape[1]
+        else:
+            found = self._track(image)
+            # A marker vanished from its window: look at the whole frame next time
+            self.rescan = any(id not in found for id in self.markers)
+        self.markers = found
+        self.frame += 1
+        self.cost = time.perf_counter() - start
+
+        if not found:
+            return (), None
+        ids = np.array([[id] for id in found], dtype=np.int32)
+        corners = tuple(c.reshape(1, 4, 2).astype(np.float32) for c in found.values())
+        return corners, ids
+
+    def _track(self, image):
+        height, width = image.shape[:2]
+        found = {}
+        self.pixels = 0
+        for id, corners in self.markers.items():
+            if id in found:
+                continue
+            low = corners.min(axis=0)
+            high = corners.max(axis=0)
+            pad = (high - low).max() * self.margin
+            x0, y0 = np.maximum(low - pad, 0).astype(int)
+            x1, y1 = np.minimum(high + pad + 1, (width, height)).astype(int)
+            window = image[y0:y1, x0:x1]
+            if window.size == 0:
+                continue
+            if self.scale != 1.0:
+                window = cv2.resize(window, None, fx=self.scale, fy=self.scale, interpolation=cv2.INTER_AREA)
+            self.pixels += window.shape[0] * window.shape[1]
+            self.window_scans += 1
+
+            window_corners, window_ids, _ = self.detector.detectMarkers(window)
+            if window_ids is None:
+                continue
+            # Windows can overlap, keep the first sighting of every marker
+            for c, i in zip(window_corners, window_ids.ravel()):
+                found.setdefault(int(i), c[0] / self.scale + (x0, y0))
+        return found
+
+    def stats(self):
+        return {'full_scans': self.full_scans,
+                'window_scans': self.window_scans,
+                'pixels': self.pixels,
+                'cost_ms': round(self.cost * 1000, 2)}
@@ -0,0 +1,1097 @@
+'''
+Unity socket protocol
+
+Messages are framed: an 8-byte header (magic b'UB', version, kind, body
+length) followed by the body. The messages sent every frame have a fixed
+binary layout of little-endian float32 (a skeleton is 60 bytes instead of
+about 400 of JSON); anything else is sent as a JSON body.
+    JSON      UTF-8 JSON
+    SKELETON  Lab 3 skeleton {Head_x, Head_y, ... RLeg_z}, 15 floats in JOINTS order
+    RESPONSE  Lab 4 response: flags byte (FLAGS bits) + 7 {x, y, z} vectors in VECTORS order
+    MARKERS   Lab 2 {'messages': [{'id', 'position'}]}: count + (uint16 id, 3 floats) each
+    DELTA     Lab 4 response delta (see DeltaEncoder): seq, base, keyframe flag and
+              a mask of the RESPONSE fields present, then those fields
+
+The framing is negotiated from the first bytes Unity sends: a frame header
+switches the connection to framed messages, a '{' keeps the original bare
+JSON, so a Unity build without framing keeps working. Both directions go
+through a streaming decoder, so messages split over several reads or
+coalesced into one read are decoded correctly.
+UNITY_PROTOCOL=framed or =json forces a format instead of negotiating it.
+
+DeltaEncoder turns a stream of state messages into deltas: only the fields
+that moved more than their epsilon since they were last sent, numbered, with
+a full keyframe every keyframe_every messages and after every reconnect.
+A receiver (DeltaDecoder) applies a delta only if it continues the last one
+it applied (base == previous seq + 1) and otherwise waits for the next
+keyframe.
+
+Optionally the high-rate streams (poses, cart) go over UDP instead, one
+datagram per message: a 20-byte header (magic b'UD', version, kind, session,
+sequence number, send time) and the same body as a frame. A lost datagram
+then only loses that update instead of holding back every later one behind
+the TCP retransmission; the receiver (UdpReceiver) drops datagrams older than
+the newest it has. The session is random per sender, so when the client
+restarts (sequence numbers from 1 again) the receiver starts a new stream
+instead of dropping everything as late. The calibration handshake stays on TCP.
+
+UnityHub turns the client around: it listens and sends every message to all
+the Unity instances connected (headsets, a spectator view), each with its own
+format, queue and rate limit; a message is serialized once per format, not
+once per subscriber. open_unity() picks the hub or the bridge.
+Run this file for a loopback comparison of TCP and UDP latency under loss,
+and of the fan-out cost for 1 to 16 subscribers.
+'''
+import codecs
+import heapq
+import json
+import os
+import random
+import re
+import select
+import socket
+import struct
+import threading
+import time
+from collections import deque
+
+MAGIC = b'UB'
+VERSION = 1
+HEADER = struct.Struct('<2sBBI')            # magic, version, kind, body length
+JSON, SKELETON, RESPONSE, MARKERS, DELTA = range(5)
+MAX_BODY = 1 << 20
+
+JOINTS = ('Head', 'LHand', 'RHand', 'LLeg', 'RLeg')
+SKELETON_FIELDS = tuple(f'{joint}_{axis}' for joint in JOINTS for axis in 'xyz')
+SKELETON_BODY = struct.Struct('<15f')
+
+FLAGS = ('needsRefill', 'isDangerous', 'hasSkeletonData')
+VECTORS = ('headPosition', 'leftHandPosition', 'rightHandPosition', 'leftLegPosition', 'rightLegPosition',
+           'cartPosition', 'cartRotation')
+RESPONSE_BODY = struct.Struct('<B21f')
+
+MARKER_COUNT = struct.Struct('<H')
+MARKER = struct.Struct('<H3f')
+
+DELTA_FIELDS = ('seq', 'base', 'keyframe', 'changes')
+DELTA_HEADER = struct.Struct('<IIBH')       # seq, base, keyframe, mask of FLAGS + VECTORS
+VECTOR = struct.Struct('<3f')
+
+UDP_MAGIC = b'UD'
+UDP_VERSION = 2                             # 1 had no session
+UDP_HEADER = struct.Struct('<2sBBIId')      # magic, version, kind, session, seq, send time (time.time())
+
+# What encoding a message Unity cannot represent raises (numpy scalars, values out of range...)
+ENCODE_ERRORS = (TypeError, ValueError, KeyError, OverflowError, struct.error)
+
+# A complete JSON string, a lone quote (string cut off by the end of the buffer) or a brace
+JSON_TOKEN = re.compile(r'"(?:[^"\\]|\\.)*"|"|[{}]')
+
+
+###############  Binary layouts  ###############
+
+def message_kind(msg):
+    "Binary layout of a message, JSON when it has none"
+    if isinstance(msg, dict):
+        if len(msg) == len(SKELETON_FIELDS) and all(field in msg for field in SKELETON_FIELDS):
+            return SKELETON
+        if all(field in msg for field in FLAGS + VECTORS) and len(msg) == len(FLAGS) + len(VECTORS):
+            return RESPONSE
+        if list(msg) == ['messages'] and all(list(m) == ['id', 'position'] for m in msg['messages']):
+            return MARKERS
+        if tuple(msg) == DELTA_FIELDS and all(field in FLAGS + VECTORS for field in msg['changes']):
+            return DELTA
+    return JSON
+
+
+def encode_body(kind, msg):
+    if kind == SKELETON:
+        return SKELETON_BODY.pack(*[msg[field] for field in SKELETON_FIELDS])
+    if kind == RESPONSE:
+        flags = sum(1 << bit for bit, flag in enumerate(FLAGS) if msg[flag])
+        values = [msg[vector][axis] for vector in VECTORS for axis in 'xyz']
+        return RESPONSE_BODY.pack(flags, *values)
+    if kind == MARKERS:
+        markers = msg['messages']
+        return MARKER_COUNT.pack(len(markers)) + b''.join(
+            MARKER.pack(m['id'], m['position']['x'], m['position']['y'], m['position']['z']) for m in markers)
+    if kind == DELTA:
+        changes = msg['changes']
+        mask = sum(1 << bit for bit, field in enumerate(FLAGS + VECTORS) if field in changes)
+        body = [DELTA_HEADER.pack(msg['seq'], msg['base'], msg['keyframe'], mask)]
+        if any(flag in changes for flag in FLAGS):
+            body.append(bytes([sum(1 << bit for bit, flag in enumerate(FLAGS) if changes.get(flag))]))
+        body += [VECTOR.pack(changes[v]['x'], changes[v]['y'], changes[v]['z']) for v in VECTORS if v in changes]
+        return b''.join(body)
+    return json.dumps(msg).encode('utf-8')
+
+
+def decode_body(kind, body):
+    if kind == SKELETON:
+        return dict(zip(SKELETON_FIELDS, SKELETON_BODY.unpack(body)))
+    if kind == RESPONSE:
+        flags, *values = RESPONSE_BODY.unpack(body)
+        msg = {flag: bool(flags >> bit & 1) for bit, flag in enumerate(FLAGS)}
+        for index, vector in enumerate(VECTORS):
+            x, y, z = values[3 * index:3 * index + 3]
+            msg[vector] = {'x': x, 'y': y, 'z': z}
+        return msg
+    if kind == MARKERS:
+        count, = MARKER_COUNT.unpack_from(body)
+        markers = []
+        for offset in range(MARKER_COUNT.size, MARKER_COUNT.size + count * MARKER.size, MARKER.size):
+            id, x, y, z = MARKER.unpack_from(body, offset)
+            markers.append({'id': id, 'position': {'x': x, 'y': y, 'z': z}})
+        return {'messages': markers}
+    if kind == DELTA:
+        seq, base, keyframe, mask = DELTA_HEADER.unpack_from(body)
+        offset = DELTA_HEADER.size
+        changes = {}
+        if mask & ((1 << len(FLAGS)) - 1):
+            if offset >= len(body):
+                raise ValueError("Delta body truncated before its flags")
+            flags = body[offset]
+            offset += 1
+            for bit, flag in enumerate(FLAGS):
+                if mask >> bit & 1:
+                    changes[flag] = bool(flags >> bit & 1)
+        for bit, vector in enumerate(VECTORS, len(FLAGS)):
+            if mask >> bit & 1:
+                x, y, z = VECTOR.unpack_from(body, offset)
+                offset += VECTOR.size
+                changes[vector] = {'x': x, 'y': y, 'z': z}
+        return {'seq': seq, 'base': base, 'keyframe': bool(keyframe), 'changes': changes}
+    return json.loads(body.decode('utf-8'))
+
+
+def encode_frame(msg):
+    kind = message_kind(msg)
+    body = encode_body(kind, msg)
+    return HEADER.pack(MAGIC, VERSION, kind, len(body)) + body
+
+
+###############  Deltas  ###############
+
+def is_delta(msg):
+    return isinstance(msg, dict) and tuple(msg) == DELTA_FIELDS
+
+
+def merge_deltas(old, new):
+    "One delta equivalent to applying old then new (for a coalesced queue)"
+    return {'seq': new['seq'],
+            'base': old['base'],
+            'keyframe': old['keyframe'] or new['keyframe'],
+            'changes': {**old['changes'], **new['changes']}}
+
+
+class DeltaEncoder:
+    '''
+    State messages (dicts of flags, numbers and {x, y, z} vectors) -> deltas.
+    A field is sent when it differs from the value last sent for it by more
+    than its epsilon (epsilons: field -> epsilon, default epsilon), so slow
+    drift is sent once it adds up.
+    '''
+    def __init__(self, keyframe_every=30, epsilon=0.001, epsilons=None):
+        self.keyframe_every = keyframe_every
+        self.epsilon = epsilon
+        self.epsilons = epsilons or {}
+        self.sent = {}                  # field -> value last sent
+        self.seq = 0
+        self.count = 0
+        self.generation = None
+        self.keyframes = 0
+        self.fields_sent = 0
+        self.fields_skipped = 0
+
+    def changed(self, field, value):
+        if field not in self.sent:
+            return True
+        last = self.sent[field]
+        if isinstance(value, dict):
+            epsilon = self.epsilons.get(field, self.epsilon)
+            return any(abs(value[axis] - last[axis]) > epsilon for axis in value)
+        if isinstance(value, float):
+            return abs(value - last) > self.epsilons.get(field, self.epsilon)
+        return value != last
+
+    def encode(self, msg, generation=None):
+        '''
+        Delta of msg, None when nothing changed. generation identifies the
+        connection (UnityBridge.connections): a new one gets a keyframe.
+        '''
+        keyframe = self.count % self.keyframe_every == 0 or generation != self.generation
+        self.generation = generation
+        self.count += 1
+        if keyframe:
+            changes = dict(msg)
+            self.keyframes += 1
+        else:
+            changes = {field: value for field, value in msg.items() if self.changed(field, value)}
+            if not changes:
+                self.fields_skipped += len(msg)
+                return None
+        self.fields_sent += len(changes)
+        self.fields_skipped += len(msg) - len(changes)
+        for field, value in changes.items():
+            self.sent[field] = dict(value) if isinstance(value, dict) else value
+        self.seq += 1
+        return {'seq': self.seq, 'base': self.seq, 'keyframe': keyframe, 'changes': changes}
+
+    def stats(self):
+        return {'seq': self.seq, 'keyframes': self.keyframes,
+                'fields_sent': self.fields_sent, 'fields_skipped': self.fields_skipped}
+
+
+class DeltaDecoder:
+    "Receiving side of DeltaEncoder: the full state, rebuilt from keyframes and deltas"
+    def __init__(self):
+        self.state = None
+        self.seq = None
+        self.ignored = 0
+
+    def apply(self, delta):
+        "Current state, or None until a keyframe arrives (after a gap as well)"
+        if delta['keyframe']:
+            self.state = {}
+        elif self.state is None or delta['base'] != self.seq + 1:
+            # Missed a delta: out of sync until the next keyframe
+            self.state = None
+            self.ignored += 1
+            return None
+        self.state.update(delta['changes'])
+        self.seq = delta['seq']
+        return self.state
+
+
+###############  Streaming decoder  ###############
+
+def object_end(text, start):
+    "Index after the JSON object starting at text[start], None while it is incomplete"
+    depth = 0
+    for match in JSON_TOKEN.finditer(text, start):
+        token = match.group()
+        if token == '"':
+            return None
+        if token == '{':
+            depth += 1
+        elif token == '}':
+            depth -= 1
+            if depth == 0:
+                return match.end()
+    return None
+
+
+class StreamDecoder:
+    '''
+    feed() bytes as they arrive, messages() returns every complete message.
+    mode 'framed' or 'json', None detects it from the first byte.
+    '''
+    def __init__(self, mode=None):
+        self.mode = mode
+        self.buffer = bytearray()
+        self.text = ''
+        self.utf8 = codecs.getincrementaldecoder('utf-8')()
+        self.errors = 0
+
+    def feed(self, data):
+        if self.mode is None:
+            data = bytes(self.buffer) + data
+            self.buffer.clear()
+            stripped = data.lstrip()
+            if not stripped:
+                return
+            if stripped[:1] == MAGIC[:1]:
+                self.mode = 'framed'
+            else:
+                self.mode = 'json'
+        if self.mode == 'framed':
+            self.buffer += data
+        else:
+            self.text += self.utf8.decode(data)
+
+    def messages(self):
+        return self._frames() if self.mode == 'framed' else self._json()
+
+    def _frames(self):
+        messages = []
+        while len(self.buffer) >= HEADER.size:
+            magic, version, kind, length = HEADER.unpack_from(self.buffer)
+            if magic != MAGIC or version != VERSION or length > MAX_BODY:
+                # Out of sync: skip to the next magic
+                self.errors += 1
+                index = self.buffer.find(MAGIC, 1)
+                del self.buffer[:index if index > 0 else len(self.buffer)]
+                continue
+            if len(self.buffer) < HEADER.size + length:
+                break
+            body = bytes(self.buffer[HEADER.size:HEADER.size + length])
+            del self.buffer[:HEADER.size + length]
+            try:
+                messages.append(decode_body(kind, body))
+            except (struct.error, ValueError, IndexError) as error:
+                self.errors += 1
+                print("[WARNING] Dropped a malformed message:", error)
+        return messages
+
+    def _json(self):
+        "Bare JSON objects back to back, the last one may be incomplete"
+        messages = []
+        while True:
+            start = self.text.find('{')
+            if start < 0:
+                self.text = ''
+                return messages
+            if self.text[:start].strip():
+                self.errors += 1        # garbage between objects
+            end = object_end(self.text, start)
+            if end is None:
+                self.text = self.text[start:]
+                return messages
+            try:
+                messages.append(json.loads(self.text[start:end]))
+            except ValueError as error:
+                self.errors += 1
+                print("[WARNING] Dropped a malformed message:", error)
+            self.text = self.text[end:]
+
+
+###############  UDP  ###############
+
+class UdpSender:
+    "One datagram per message, never blocks (a datagram that cannot be sent is dropped)"
+    def __init__(self, host, port):
+        self.address = (host, port)
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.sock.setblocking(False)
+        self.lock = threading.Lock()
+        self.session = random.getrandbits(32)      # tells this sender's sequence numbers from a previous run's
+        self.seq = 0
+        self.sent = 0
+        self.dropped = 0
+
+    def send(self, msg):
+        kind = message_kind(msg)
+        body = encode_body(kind, msg)
+        with self.lock:
+            self.seq = self.seq % 0xFFFFFFFF + 1
+            datagram = UDP_HEADER.pack(UDP_MAGIC, UDP_VERSION, kind, self.session, self.seq, time.time()) + body
+            try:
+                self.sock.sendto(datagram, self.address)
+                self.sent += 1
+            except OSError:
+                self.dropped += 1       # the next message supersedes it anyway
+
+    def close(self):
+        self.sock.close()
+
+
+class UdpReceiver:
+    "Receiving side of UdpSender (what Unity does): out-of-order datagrams are dropped"
+    def __init__(self, port=0, host='0.0.0.0'):
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.sock.bind((host, port))
+        self.port = self.sock.getsockname()[1]
+        self.session = None
+        self.last_seq = 0
+        self.received = 0
+        self.late = 0                   # arrived after a newer one
+        self.lost = 0                   # sequence gaps
+        self.sessions = 0               # senders seen (a restarted client is a new one)
+        self.errors = 0                 # malformed datagrams
+
+    def receive(self, timeout=None):
+        "(message, seq, send time) of the next datagram newer than the last one, None on timeout"
+        while True:
+            if not select.select([self.sock], [], [], timeout)[0]:
+                return None
+            data = self.sock.recv(65536)
+            if len(data) < UDP_HEADER.size:
+                continue
+            magic, version, kind, session, seq, sent_at = UDP_HEADER.unpack_from(data)
+            if magic != UDP_MAGIC or version != UDP_VERSION:
+                continue
+            if session != self.session:
+                # New sender (or the client restarted): its sequence starts over
+                self.session = session
+                self.sessions += 1
+                self.last_seq = 0
+            if seq <= self.last_seq:
+                self.late += 1
+                continue
+            try:
+                msg = decode_body(kind, data[UDP_HEADER.size:])
+            except (struct.error, ValueError, IndexError):
+                self.errors += 1
+                continue
+            self.lost += seq - self.last_seq - 1
+            self.last_seq = seq
+            self.received += 1
+            return msg, seq, sent_at
+
+    def close(self):
+        self.sock.close()
+
+
+###############  Bridge  ###############
+
+class Endpoint:
+    '''
+    What UnityBridge and UnityHub share: an I/O thread (started by the
+    subclass once it is set up) woken through a socketpair, and the inbox of
+    decoded messages read by receive().
+    '''
+    def __init__(self, max_queue):
+        self.inbox = deque(maxlen=max_queue)        # received messages, oldest dropped
+        self.condition = threading.Condition()
+        self.received = 0
+        self.dropped = 0                            # queue / inbox overflow
+        self.invalid = 0                            # messages dropped because they cannot be encoded
+        self.error = None                           # what stopped the I/O thread, if it died
+        self.waker, self.wakeup = socket.socketpair()
+        self.waker.setblocking(False)
+        self.wakeup.setblocking(False)
+        self.running = True
+        self.thread = threading.Thread(target=self._main, daemon=True)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def receive(self, timeout=0):
+        '''
+        Oldest received message. Raises BlockingIOError if there is none
+        after timeout seconds (None waits for one).
+        '''
+        with self.condition:
+            if not self.condition.wait_for(lambda: self.inbox or not self.running, timeout):
+                raise BlockingIOError("No message from Unity")
+            if not self.inbox:
+                self._check()
+                raise ConnectionError(f"{type(self).__name__} closed")
+            return self.inbox.popleft()
+
+    def close(self):
+        self.running = False
+        self._wake()
+        with self.condition:
+            self.condition.notify_all()
+        self.thread.join(timeout=1.0)
+        self.waker.close()
+        self.wakeup.close()
+
+    def _check(self):
+        "Raise if the I/O thread died, instead of queueing messages nobody will send"
+        if self.error is not None:
+            raise ConnectionError(f"{type(self).__name__} I/O thread died: {type(self.error).__name__} - {self.error}") from self.error
+
+    def _main(self):
+        try:
+            self._run()
+        except Exception as error:
+            self.error = error
+            print(f"[ERROR] {type(self).__name__} I/O thread died:", type(error).__name__, "-", error)
+            with self.condition:
+                self.running = False
+                self.condition.notify_all()
+
+    def _serialize(self, msg, framed):
+        "Bytes of msg in the connection's format, None (message dropped and counted) if it cannot be encoded"
+        try:
+            return encode_frame(msg) if framed else json.dumps(msg).encode('utf-8')
+        except ENCODE_ERRORS as error:
+            self.invalid += 1
+            print("[WARNING] Dropping a message that cannot be encoded:", type(error).__name__, "-", error)
+            return None
+
+    def _wake(self):
+        try:
+            self.waker.send(b'\0')
+        except (BlockingIOError, OSError):
+            pass        # already woken (or closing)
+
+    def _drain_wakeup(self):
+        try:
+            while self.wakeup.recv(4096):
+                pass
+        except (BlockingIOError, OSError):
+            pass
+
+    def _deliver(self, messages):
+        "Hand decoded messages to receive()"
+        if messages:
+            with self.condition:
+                self.dropped += max(0, len(self.inbox) + len(messages) - self.inbox.maxlen)
+                self.inbox.extend(messages)
+                self.received += len(messages)
+                self.condition.notify_all()
+
+
+class UnityBridge(Endpoint):
+    '''
+    Connection to Unity owned by an I/O thread, so the frame loop never
+    blocks on the network.
+    send() only queues: with a stream name the message replaces the unsent
+    one of that stream (a pose superseded by a newer pose is never sent),
+    without one it goes to a bounded FIFO (oldest dropped when full).
+    receive() returns messages the I/O thread already decoded.
+    The bridge connects in the background and reconnects with a growing
+    delay whenever the connection drops; each connection negotiates its
+    format again (see the top of this file).
+    With a udp_port, the messages of udp_streams are sent as UDP datagrams
+    right away instead (TCP still carries everything else).
+    '''
+    def __init__(self, host, port, mode=os.environ.get('UNITY_PROTOCOL', 'auto'),
+                 max_queue=64, reconnect_delay=0.5, max_reconnect_delay=5.0, udp_port=None, udp_streams=()):
+        Endpoint.__init__(self, max_queue)
+        self.address = (host, port)
+        self.udp = UdpSender(host, udp_port) if udp_port else None
+        self.udp_streams = set(udp_streams)
+        self.forced = None if mode == 'auto' else mode
+        self.reconnect_delay = reconnect_delay
+        self.max_reconnect_delay = max_reconnect_delay
+        self.latest = {}                            # stream -> (queued at, message)
+        self.queue = deque(maxlen=max_queue)        # (queued at, message), no coalescing
+        self.connected = threading.Event()
+        self.decoder = StreamDecoder(self.forced)
+        # Backpressure metrics
+        self.sent = 0
+        self.sent_bytes = 0
+        self.coalesced = 0                          # messages replaced before being sent
+        self.reconnects = 0
+        self.connections = 0                        # connections made so far, identifies the current one
+        self.latency = 0.0                          # queue-to-socket time of the last write (oldest message)
+        self.thread.start()
+
+    ###  Frame loop side  ###
+
+    def send(self, msg, stream='default'):
+        "Queue a message, never blocks. Coalesced deltas are merged, not replaced."
+        self._check()
+        if self.udp is not None and stream in self.udp_streams:
+            self.udp.send(msg)
+            return
+        with self.condition:
+            if stream is None:
+                if len(self.queue) == self.queue.maxlen:
+                    self.dropped += 1
+                self.queue.append((time.perf_counter(), msg))
+            else:
+                queued_at = time.perf_counter()
+                if stream in self.latest:
+                    self.coalesced += 1
+                    queued_at, previous = self.latest[stream]
+                    if is_delta(previous) and is_delta(msg):
+                        msg = merge_deltas(previous, msg)
+                self.latest[stream] = (queued_at, msg)
+        self._wake()
+
+    def stats(self):
+        with self.condition:
+            return {'connected': self.connected.is_set(),
+                    'framed': self.decoder.mode == 'framed',
+                    'queued': len(self.latest) + len(self.queue),
+                    'sent': self.sent,
+                    'sent_bytes': self.sent_bytes,
+                    'coalesced': self.coalesced,
+                    'dropped': self.dropped,
+                    'invalid': self.invalid,
+                    'received': self.received,
+                    'reconnects': self.reconnects,
+                    'latency_ms': round(self.latency * 1000, 2),
+                    'udp_sent': self.udp.sent if self.udp else 0,
+                    'udp_dropped': self.udp.dropped if self.udp else 0}
+
+    def close(self):
+        Endpoint.close(self)
+        if self.udp is not None:
+            self.udp.close()
+
+    ###  I/O thread  ###
+
+    def _run(self):
+        delay = self.reconnect_delay
+        while self.running:
+            try:
+                sock = socket.create_connection(self.address, timeout=self.max_reconnect_delay)
+            except OSError as error:
+                print(f"[WARNING] Cannot reach Unity at {self.address[0]}:{self.address[1]}:", error)
+                self._sleep(delay)
+                delay = min(delay * 2, self.max_reconnect_delay)
+                continue
+            delay = self.reconnect_delay
+            sock.setblocking(False)
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            self.decoder = StreamDecoder(self.forced)
+            self.connections += 1
+            self.connected.set()
+            print(f"[INFO] Connected to Unity at {self.address[0]}:{self.address[1]}")
+            try:
+                self._serve(sock)
+            except OSError as error:
+                print("[WARNING] Unity connection lost:", error)
+            finally:
+                self.connected.clear()
+                sock.close()
+            if self.running:
+                self.reconnects += 1
+                self._sleep(delay)
+
+    def _sleep(self, seconds):
+        "Wait before reconnecting, returns early on close()"
+        select.select([self.wakeup], [], [], seconds)
+        self._drain_wakeup()
+
+    def _take(self):
+        "Every queued message, oldest first"
+        with self.condition:
+            items = sorted(list(self.queue) + list(self.latest.values()), key=lambda item: item[0])
+            self.queue.clear()
+            self.latest.clear()
+        return items
+
+    def _serve(self, sock):
+        out = b''           # encoded messages not fully written yet
+        queued_at = 0.0
+        count = 0
+        while self.running:
+            if not out:
+                items = self._take()
+                framed = self.decoder.mode == 'framed'
+                encoded = [(at, self._serialize(msg, framed)) for at, msg in items]
+                encoded = [item for item in encoded if item[1] is not None]
+                if encoded:
+                    out = b''.join(data for _, data in encoded)
+                    queued_at, count = encoded[0][0], len(encoded)
+            readable, writable, _ = select.select([sock, self.wakeup], [sock] if out else [], [], 1.0)
+            if self.wakeup in readable:
+                self._drain_wakeup()
+            if sock in readable:
+                data = sock.recv(65536)
+                if not data:
+                    raise ConnectionError("closed by Unity")
+                self.decoder.feed(data)
+                self._deliver(self.decoder.messages())
+            if sock in writable and out:
+                written = sock.send(out)
+                out = out[written:]
+                self.sent_bytes += written
+                if not out:
+                    self.sent += count
+                    self.latency = time.perf_counter() - queued_at
+
+
+###############  Fan-out server  ###############
+
+class Update:
+    '''
+    A message queued for every subscriber of a UnityHub. Its encodings are
+    kept (one per format, framed or bare JSON), so a message is serialized at
+    most twice however many subscribers it goes to.
+    '''
+    __slots__ = ('msg', 'queued_at', 'encoded')
+
+    def __init__(self, msg, queued_at):
+        self.msg = msg
+        self.queued_at = queued_at
+        self.encoded = {}                           # framed (bool) -> bytes
+
+
+class Subscriber:
+    '''
+    One connection to a UnityHub, with its own format (negotiated like a
+    bridge connection), queue and rate limit, so a slow or distant headset
+    only loses its own updates.
+    The queue works like the bridge's: the latest Update per stream plus a
+    bounded FIFO for stream None. A stream is sent at most once per interval;
+    updates arriving in between replace the pending one.
+    '''
+    def __init__(self, sock, address, forced, max_queue, rate):
+        self.sock = sock
+        self.address = address
+        self.decoder = StreamDecoder(forced)
+        self.latest = {}                            # stream -> Update
+        self.queue = deque(maxlen=max_queue)        # Updates, no coalescing
+        self.last_sent = {}                         # stream -> time it was last taken
+        self.interval = 1.0 / rate if rate else 0.0
+        self.out = b''                              # encoded updates not fully written yet
+        self.count = 0                              # updates in out
+        self.queued_at = 0.0                        # oldest update in out
+        self.sent = 0
+        self.sent_bytes = 0
+        self.coalesced = 0
+        self.dropped = 0
+        self.latency = 0.0
+
+    def offer(self, stream, update):
+        "Queue an update (under the hub lock)"
+        if stream is None:
+            if len(self.queue) == self.queue.maxlen:
+                self.dropped += 1
+            self.queue.append(update)
+            return
+        previous = self.latest.get(stream)
+        if previous is not None:
+            self.coalesced += 1
+            if is_delta(previous.msg) and is_delta(update.msg):
+                # This subscriber's own merged delta, encoded for it alone
+                update = Update(merge_deltas(previous.msg, update.msg), previous.queued_at)
+        self.latest[stream] = update
+
+    def take(self, now):
+        "The updates that may be sent now, oldest first (under the hub lock)"
+        items = list(self.queue)
+        self.queue.clear()
+        for stream in [stream for stream in self.latest if now - self.last_sent.get(stream, -1e9) >= self.interval]:
+            items.append(self.latest.pop(stream))
+            self.last_sent[stream] = now
+        items.sort(key=lambda update: update.queued_at)
+        return items
+
+    def wait(self, now):
+        "Seconds until a rate-limited update may be taken, None if none is pending or the socket is still busy"
+        if self.out or self.queue or not self.latest:
+            # Unsent bytes: select() wakes up when the socket is writable again
+            return None
+        return max(0.0, min(self.last_sent.get(stream, -1e9) + self.interval for stream in self.latest) - now)
+
+    def stats(self):
+        return {'address': f'{self.address[0]}:{self.address[1]}',
+                'framed': self.decoder.mode == 'framed',
+                'rate': round(1.0 / self.interval, 1) if self.interval else None,
+                'queued': len(self.latest) + len(self.queue),
+                'sent': self.sent,
+                'sent_bytes': self.sent_bytes,
+                'coalesced': self.coalesced,
+                'dropped': self.dropped,
+                'latency_ms': round(self.latency * 1000, 2)}
+
+
+class UnityHub(Endpoint):
+    '''
+    Publish/subscribe server: instead of connecting to one Unity, listen on
+    port and send every message to all the Unity instances connected to it
+    (several headsets, a spectator view), same interface as UnityBridge.
+    send() wraps the message once and offers it to every subscriber's queue;
+    the I/O thread encodes it the first time a subscriber needs that format
+    and reuses the bytes for the others, so the frame loop does no
+    serialization and the I/O thread at most one per format.
+    Each subscriber has its own coalescing queue and a rate limit (rate Hz,
+    None for no limit); a subscriber can ask for its own rate by sending
+    {RATE_REQUEST: hz}. Messages sent with no subscriber connected are lost.
+    A new subscriber increments connections, so a DeltaEncoder fed with it
+    starts with a keyframe that the newcomer can decode.
+    The hub has no UDP transport.
+    '''
+    RATE_REQUEST = 'subscriberRate'
+
+    def __init__(self, port, host='', mode=os.environ.get('UNITY_PROTOCOL', 'auto'),
+                 max_queue=64, rate=None, max_subscribers=16):
+        Endpoint.__init__(self, max_queue)
+        self.listener = socket.create_server((host, port))
+        self.listener.setblocking(False)
+        self.port = self.listener.getsockname()[1]
+        self.forced = None if mode == 'auto' else mode
+        self.max_queue = max_queue
+        self.rate = rate
+        self.max_subscribers = max_subscribers
+        self.subscribers = []
+        self.connections = 0                        # subscribers accepted so far
+        self.published = 0                          # send() calls
+        self.encodings = 0                          # serializations, grows with formats, not subscribers
+        self.rejected = 0
+        print(f"[INFO] Waiting for Unity subscribers on port {self.port}")
+        self.thread.start()
+
+    ###  Frame loop side  ###
+
+    def send(self, msg, stream='default'):
+        "Queue a message for every subscriber, never blocks"
+        self._check()
+        update = Update(msg, time.perf_counter())
+        with self.condition:
+            self.published += 1
+            for subscriber in self.subscribers:
+                subscriber.offer(stream, update)
+        self._wake()
+
+    def stats(self):
+        with self.condition:
+            subscribers = [subscriber.stats() for subscriber in self.subscribers]
+            return {'subscribers': len(subscribers),
+                    'connections': self.connections,
+                    'rejected': self.rejected,
+                    'published': self.published,
+                    'encodings': self.encodings,
+                    'sent': sum(subscriber['sent'] for subscriber in subscribers),
+                    'coalesced': sum(subscriber['coalesced'] for subscriber in subscribers),
+                    'dropped': self.dropped + sum(subscriber['dropped'] for subscriber in subscribers),
+                    'invalid': self.invalid,
+                    'received': self.received,
+                    'clients': subscribers}
+
+    def close(self):
+        Endpoint.close(self)
+        for subscriber in self.subscribers:
+            subscriber.sock.close()
+        self.listener.close()
+
+    ###  I/O thread  ###
+
+    def _encode(self, update, framed):
+        "Bytes of the update in a format, b'' if it cannot be encoded (dropped once, not per subscriber)"
+        if framed not in update.encoded:
+            update.encoded[framed] = self._serialize(update.msg, framed) or b''
+            self.encodings += 1
+        return update.encoded[framed]
+
+    def _run(self):
+        while self.running:
+            now = time.perf_counter()
+            with self.condition:
+                batches = [(subscriber, subscriber.take(now)) for subscriber in self.subscribers if not subscriber.out]
+                waits = [wait for wait in (subscriber.wait(now) for subscriber in self.subscribers) if wait is not None]
+            for subscriber, items in batches:
+                framed = subscriber.decoder.mode == 'framed'
+                items = [update for update in items if self._encode(update, framed)]
+                if items:
+                    subscriber.out = b''.join(self._encode(update, framed) for update in items)
+                    subscriber.queued_at, subscriber.count = items[0].queued_at, len(items)
+
+            socks = {subscriber.sock: subscriber for subscriber in self.subscribers}
+            writing = [subscriber.sock for subscriber in self.subscribers if subscriber.out]
+            readable, writable, _ = select.select([self.listener, self.wakeup] + list(socks), writing, [],
+                                                  min(waits + [1.0]))
+            if self.wakeup in readable:
+                self._drain_wakeup()
+            if self.listener in readable:
+                self._accept()
+            for sock in readable:
+                if sock in socks:
+                    self._read(socks[sock])
+            for sock in writable:
+                if socks[sock] in self.subscribers:
+                    self._write(socks[sock])
+
+    def _accept(self):
+        try:
+            sock, address = self.listener.accept()
+        except OSError:
+            return
+        if len(self.subscribers) >= self.max_subscribers:
+            print(f"[WARNING] Refusing Unity subscriber {address[0]}:{address[1]}, already {len(self.subscribers)}")
+            self.rejected += 1
+            sock.close()
+            return
+        sock.setblocking(False)
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        with self.condition:
+            self.subscribers.append(Subscriber(sock, address, self.forced, self.max_queue, self.rate))
+            self.connections += 1
+        print(f"[INFO] Unity subscriber {address[0]}:{address[1]} connected ({len(self.subscribers)} in total)")
+
+    def _drop(self, subscriber, reason):
+        with self.condition:
+            self.subscribers.remove(subscriber)
+        subscriber.sock.close()
+        print(f"[INFO] Unity subscriber {subscriber.address[0]}:{subscriber.address[1]} left:", reason)
+
+    def _read(self, subscriber):
+        try:
+            data = subscriber.sock.recv(65536)
+        except OSError as error:
+            self._drop(subscriber, error)
+            return
+        if not data:
+            self._drop(subscriber, "closed by Unity")
+            return
+        subscriber.decoder.feed(data)
+        messages = []
+        for msg in subscriber.decoder.messages():
+            if isinstance(msg, dict) and list(msg) == [self.RATE_REQUEST]:
+                rate = msg[self.RATE_REQUEST]
+                subscriber.interval = 1.0 / rate if rate else 0.0
+            else:
+                messages.append(msg)
+        self._deliver(messages)
+
+    def _write(self, subscriber):
+        try:
+            written = subscriber.sock.send(subscriber.out)
+        except OSError as error:
+            self._drop(subscriber, error)
+            return
+        subscriber.out = subscriber.out[written:]
+        subscriber.sent_bytes += written
+        if not subscriber.out:
+            subscriber.sent += subscriber.count
+            subscriber.latency = time.perf_counter() - subscriber.queued_at
+
+
+def open_unity(host, port, serve_port=None, **options):
+    '''
+    UnityHub listening on serve_port when it is set (every Unity connecting
+    there gets the same updates), otherwise a UnityBridge to host:port.
+    options go to either one (mode, max_queue...); an option the hub does not
+    have raises instead of being ignored, except an unset udp_port.
+    '''
+    if serve_port:
+        if options.pop('udp_port', None):
+            raise ValueError("UnityHub has no UDP transport, set either the serve port or the UDP port")
+        options.pop('udp_streams', None)
+        return UnityHub(serve_port, **options)
+    return UnityBridge(host, port, **options)
+
+
+###############  Loopback harness  ###############
+
+class LossyRelay:
+    '''
+    Forward local traffic with injected loss.
+    UDP: each datagram is dropped with probability loss, the others are
+    delayed by delay + uniform(0, jitter), so they can arrive out of order.
+    TCP: every byte arrives, but a chunk "lost" with probability loss is held
+    for rto (the retransmission timeout) and everything behind it waits too,
+    which is TCP's head-of-line blocking.
+    '''
+    def __init__(self, kind, source, forward, loss, delay=0.002, jitter=0.002, rto=0.2, seed=0):
+        self.kind = kind
+        self.source = source
+        self.forward = forward          # data -> None
+        self.loss, self.delay, self.jitter, self.rto = loss, delay, jitter, rto
+        self.random = random.Random(seed)
+        self.running = True
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+
+    def _run(self):
+        pending = []                    # (due, order, data)
+        order = 0
+        stalled_until = 0.0
+        while self.running:
+            now = time.perf_counter()
+            while pending and pending[0][0] <= now:
+                self.forward(heapq.heappop(pending)[2])
+            timeout = min(0.01, pending[0][0] - now) if pending else 0.01
+            if not select.select([self.source], [], [], max(timeout, 0.0))[0]:
+                continue
+            data = self.source.recv(65536)
+            if not data:
+                return
+            now = time.perf_counter()
+            lost = self.random.random() < self.loss
+            if self.kind == 'udp':
+                if lost:
+                    continue
+                due = now + self.delay + self.random.uniform(0, self.jitter)
+            else:
+                # Retransmitted rto later, and in order: never before the chunks ahead of it
+                due = max(now + self.delay + (self.rto if lost else 0.0), stalled_until)
+                stalled_until = due
+            heapq.heappush(pending, (due, order, data))
+            order += 1
+
+    def stop(self):
+        self.running = False
+        self.thread.join(timeout=1.0)
+
+
+def percentiles(latencies):
+    "p50 / p95 / p99 / max in ms of latencies in seconds"
+    values = sorted(latencies) or [0.0]
+    result = {f'p{p}': round(values[min(len(values) - 1, len(values) * p // 100)] * 1000, 2) for p in (50, 95, 99)}
+    result['max'] = round(values[-1] * 1000, 2)
+    return result
+
+
+def loopback(transport, loss, count=1000, rate=200.0):
+    "Send count skeletons at rate through a LossyRelay, latency distribution at the receiver"
+    skeleton = {field: 0.0 for field in SKELETON_FIELDS}
+    latencies = []
+    if transport == 'udp':
+        receiver = UdpReceiver(0, '127.0.0.1')
+        inlet = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        inlet.bind(('127.0.0.1', 0))
+        relay = LossyRelay('udp', inlet, lambda data: inlet.sendto(data, ('127.0.0.1', receiver.port)), loss)
+        sender = UdpSender('127.0.0.1', inlet.getsockname()[1])
+        send = sender.send
+
+        def collect():
+            while True:
+                result = receiver.receive(timeout=0.5)
+                if result is None:
+                    return
+                latencies.append(time.time() - result[2])
+    else:
+        writer, inlet = socket.socketpair()
+        outlet, reader = socket.socketpair()
+        relay = LossyRelay('tcp', inlet, outlet.sendall, loss)
+        decoder = StreamDecoder('framed')
+
+        def send(msg):
+            # Framed JSON so the send time travels with the message
+            writer.sendall(encode_frame(dict(msg, sent=time.time())))
+
+        def collect():
+            while select.select([reader], [], [], 0.5)[0]:
+                decoder.feed(reader.recv(65536))
+                now = time.time()
+                latencies.extend(now - msg['sent'] for msg in decoder.messages())
+
+    collector = threading.Thread(target=collect, daemon=True)
+    collector.start()
+    for _ in range(count):
+        send(skeleton)
+        time.sleep(1 / rate)
+    collector.join()
+    relay.stop()
+    result = percentiles(latencies)
+    result['delivered'] = f'{len(latencies)}/{count}'
+    return result
+
+
+def fanout(subscribers, count=500, rate=200.0):
+    "Publish count skeletons at rate through a UnityHub to local subscribers, serializations and send() cost"
+    skeleton = {field: 0.0 for field in SKELETON_FIELDS}
+    hub = UnityHub(0, '127.0.0.1')
+    clients = [socket.create_connection(('127.0.0.1', hub.port)) for _ in range(subscribers)]
+    while hub.stats()['subscribers'] < subscribers:
+        time.sleep(0.01)
+    decoders = {client: StreamDecoder('json') for client in clients}
+    received = [0]
+
+    def collect():
+        while True:
+            readable = select.select(clients, [], [], 0.5)[0]
+            if not readable:
+                return
+            for client in readable:
+                decoders[client].feed(client.recv(65536))
+                received[0] += len(decoders[client].messages())
+
+    collector = threading.Thread(target=collect, daemon=True)
+    collector.start()
+    spent = 0.0
+    for _ in range(count):
+        start = time.perf_counter()
+        hub.send(skeleton, stream='skeleton')
+        spent += time.perf_counter() - start
+        time.sleep(1 / rate)
+    collector.join()
+    stats = hub.stats()
+    hub.close()
+    for client in clients:
+        client.close()
+    return {'send_us': round(spent / count * 1e6, 1),
+            'encodings': stats['encodings'],
+            'delivered': f"{received[0]}/{count * subscribers}",
+            'coalesced': stats['coalesced']}
+
+
+if __name__ == '__main__':
+    for loss in (0.0, 0.01, 0.05):
+        for transport in ('tcp', 'udp'):
+            print(f"[INFO] loss {loss:.0%} {transport}:", loopback(transport, loss))
+    for subscribers in (1, 4, 16):
+        print(f"[INFO] fan-out to {subscribers} subscribers:", fanout(subscribers))